@@ -0,0 +1,62 @@
+import logging
+import threading
+import collections
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+class Dispatcher:
+    def __init__(self, workers: int = 8, max_in_flight: int = 100):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatcher')
+
+        # Caps how many jobs can be queued or running at once, submit() blocks past that
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending_jobs = 0
+
+        # chat_id -> jobs waiting behind the one currently running for that chat
+        self.chat_queues = {}
+
+    def submit(self, chat_id: int, job, *args):
+        self.in_flight.acquire()
+
+        with self.lock:
+            self.pending_jobs += 1
+            if chat_id in self.chat_queues:
+                self.chat_queues[chat_id].append((job, args))
+                return
+            self.chat_queues[chat_id] = collections.deque()
+
+        self.executor.submit(self.__run, chat_id, job, args)
+
+    def __run(self, chat_id: int, job, args):
+        try:
+            job(*args)
+        except Exception:
+            logger.exception('Error handling job for chat %d', chat_id)
+        finally:
+            self.in_flight.release()
+
+        with self.lock:
+            self.pending_jobs -= 1
+            if self.pending_jobs == 0:
+                self.idle.notify_all()
+
+            chat_queue = self.chat_queues[chat_id]
+            if len(chat_queue) == 0:
+                del self.chat_queues[chat_id]
+                return
+            next_job, next_args = chat_queue.popleft()
+
+        # Resubmit instead of looping so a busy chat doesn't hold on to a worker
+        self.executor.submit(self.__run, chat_id, next_job, next_args)
+
+    def join(self, timeout: float = None) -> bool:
+        with self.lock:
+            return self.idle.wait_for(lambda: self.pending_jobs == 0, timeout=timeout)
+
+    def shutdown(self):
+        self.join()
+        self.executor.shutdown()
@@ -0,0 +1,121 @@
+import threading
+import statistics
+import collections
+
+from Price import Price, round_amount
+
+class ExchangeRates:
+    # Prices pages are only scraped in their canonical form (every country in its own currency) and converted here to
+    # the currency each chat picked, so the cached pages are shared by every currency. The rates are learned by
+    # comparing a canonical prices page with the same page as eshop-prices.com serves it in each currency.
+    def __init__(self, max_converted: int = 5000):
+        self.lock = threading.Lock()
+        self.rates = {}  # currency -> {currency prices are scraped in: rate}
+
+        # Bumped whenever rates change, conversions made before are done again
+        self.version = 0
+
+        # (currency, id(value)) -> (value, version, converted). Converting the same cached object again gives back the
+        # same converted object, so anything keyed on it (like MessageCache) keeps hitting.
+        self.max_converted = max_converted
+        self.converted = collections.OrderedDict()
+
+    def learn(self, currency: str, canonical: [Price], converted: [Price]) -> int:
+        # Returns how many currencies can now be converted to currency
+        currency = currency.upper()
+        converted_by_country = {price.country: price for price in converted}
+
+        ratios = {}
+        for price in canonical:
+            converted_price = converted_by_country.get(price.country)
+            if converted_price is None or converted_price.currency != currency or not price.amount or converted_price.amount is None:
+                continue
+            ratios.setdefault(price.currency, []).append(converted_price.amount / price.amount)
+
+        # A page served in each country's own currency again (currency ignored) teaches nothing
+        ratios.pop(currency, None)
+        if len(ratios) == 0:
+            return 0
+
+        rates = {source_currency: statistics.median(source_ratios) for source_currency, source_ratios in ratios.items()}
+        rates[currency] = 1
+        with self.lock:
+            self.rates[currency] = rates
+            self.version += 1
+
+        return len(rates)
+
+    def __contains__(self, currency: str) -> bool:
+        return currency.upper() in self.rates
+
+    def convert_amount(self, amount: int, source_currency: str, currency: str) -> int:
+        # None when there is no rate from source_currency to currency
+        rate = self.rates.get(currency.upper(), {}).get(source_currency)
+        if rate is None or amount is None:
+            return None
+
+        return round_amount(round(amount * rate), currency.upper())
+
+    def convert_prices(self, prices: [Price], currency: str) -> [Price]:
+        return self.__converted(prices, currency, lambda rates: [convert_price(price, rates, currency.upper()) for price in prices])
+
+    def convert_results(self, results: {str: dict}, currency: str) -> {str: dict}:
+        # Search and games list results, {title: {'best_price', 'uri'}}
+        return self.__converted(results, currency, lambda rates: {
+            title: {**result, 'best_price': convert_price(result['best_price'], rates, currency.upper())} for title, result in results.items()
+        })
+
+    def __converted(self, value, currency: str, convert):
+        currency = currency.upper()
+        with self.lock:
+            rates = self.rates.get(currency)
+            version = self.version
+            if rates is None:
+                # Nothing learned for this currency (yet), shown the way it was scraped
+                return value
+
+            key = (currency, id(value))
+            entry = self.converted.get(key)
+            if entry is not None and entry[0] is value and entry[1] == version:
+                self.converted.move_to_end(key)
+                return entry[2]
+
+        converted = convert(rates)
+
+        with self.lock:
+            self.converted[key] = (value, version, converted)
+            self.converted.move_to_end(key)
+            while len(self.converted) > self.max_converted:
+                self.converted.popitem(last=False)
+
+        return converted
+
+    def restore(self, rates: {str: {str: float}}):
+        with self.lock:
+            if rates != self.rates:
+                self.rates = rates
+                self.version += 1
+
+    def json(self):
+        with self.lock:
+            return {'rates': self.rates}
+
+    @staticmethod
+    def load(dump) -> 'ExchangeRates':
+        exchange_rates = ExchangeRates()
+        exchange_rates.restore(dump['rates'])
+
+        return exchange_rates
+
+def convert_price(price: Price, rates: {str: float}, currency: str) -> Price:
+    # Prices in a currency there is no rate for are left as they are
+    if not isinstance(price, Price) or price.currency == currency or price.currency not in rates:
+        return price
+
+    rate = rates[price.currency]
+    return Price(
+        price.country, price.country_code,
+        round_amount(round(price.amount * rate), currency) if price.amount is not None else None,
+        round_amount(round(price.original_amount * rate), currency) if price.original_amount is not None else None,
+        currency, price.discount, price.sale_end
+    )
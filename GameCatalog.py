@@ -0,0 +1,254 @@
+import re
+import sys
+import logging
+import threading
+import collections
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+Game = collections.namedtuple('Game', ['id', 'title', 'uri'])
+
+def normalize_title(title: str) -> str:
+    # 'Pokémon™ Sword' -> 'pokemon sword'
+    title = unicodedata.normalize('NFKD', title.lower())
+    title = ''.join(c for c in title if not unicodedata.combining(c))
+    return ' '.join(re.sub('[^a-z0-9]+', ' ', title).split())
+
+def trigrams(text: str, pad: bool = True) -> {str}:
+    if pad:
+        text = f'  {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class GameCatalog:
+    # One shared record per game, so chats only need to keep the game ids of their favorites.
+    # Titles are also indexed by trigram, which lets most searches be answered without asking eshop-prices.com.
+    def __init__(self, max_results: int = 30):
+        self.games = {}  # game_id -> Game
+        self.ids_by_title = {}
+        self.lock = threading.Lock()
+
+        self.normalized_titles = {}  # game_id -> normalized title
+        self.ids_by_normalized_title = {}
+        self.trigram_index = {}  # trigram -> {game_id}
+        self.best_prices = {}  # game_id -> {currency: best_price}
+
+        # Listing page the next crawl() starts from, and whether every page has been crawled at least once
+        self.crawl_page = 1
+        self.complete = False
+
+        # Local searches answer with at most this many games, one page of eshop-prices.com's results
+        self.max_results = max_results
+
+        self.local_hits = 0
+        self.local_misses = 0
+
+        # Games added or changed since the last take_changes()
+        self.new_games = set()
+
+        # game_id -> (title, uri) or None, asked when a game isn't in memory. Other processes sharing the store
+        # (ShardedBot's shards) add games this one hasn't seen.
+        self.loader = None
+
+    @staticmethod
+    def game_id(game_uri: str) -> int:
+        # 'games/5334-super-mario-3d-world-bowser-s-fury' -> 5334
+        m = re.search('games/(\\d+)', game_uri)
+        return int(m.group(1)) if m is not None else None
+
+    def add(self, game_title: str, game_uri: str) -> int:
+        game_id = self.game_id(game_uri)
+        if game_id is None:
+            return None
+
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is not None and game.title == game_title and game.uri == game_uri:
+                return game.id
+
+            self.__store(Game(game_id, sys.intern(str(game_title)), game_uri))
+            self.new_games.add(game_id)
+
+        return game_id
+
+    def __store(self, game: Game):
+        if game.id in self.games:
+            self.__unindex(game.id)
+
+        self.games[game.id] = game
+        self.ids_by_title[game.title] = game.id
+
+        normalized_title = normalize_title(game.title)
+        self.normalized_titles[game.id] = normalized_title
+        self.ids_by_normalized_title[normalized_title] = game.id
+        for trigram in trigrams(normalized_title):
+            self.trigram_index.setdefault(trigram, set()).add(game.id)
+
+    def __unindex(self, game_id: int):
+        normalized_title = self.normalized_titles.pop(game_id)
+        self.ids_by_title.pop(self.games[game_id].title, None)
+        self.ids_by_normalized_title.pop(normalized_title, None)
+        for trigram in trigrams(normalized_title):
+            self.trigram_index[trigram].discard(game_id)
+
+    def add_results(self, search_results: {str: {str: str}}, currency: str = ''):
+        if isinstance(search_results, str):
+            return
+
+        for game_title, result in search_results.items():
+            game_id = self.add(game_title, result['uri'])
+            if game_id is not None:
+                self.best_prices.setdefault(game_id, {})[currency] = result['best_price']
+
+    def match(self, query: str) -> [int]:
+        # Games whose title contains every word of the query
+        words = normalize_title(query).split()
+        if len(words) == 0:
+            return []
+
+        with self.lock:
+            candidates = None
+            for word in words:
+                for trigram in trigrams(word, pad=False):
+                    game_ids = self.trigram_index.get(trigram, set())
+                    candidates = set(game_ids) if candidates is None else candidates & game_ids
+            if candidates is None:
+                # Only words shorter than a trigram, nothing to narrow down with
+                candidates = set(self.games)
+
+            matches = [game_id for game_id in candidates if all(word in self.normalized_titles[game_id] for word in words)]
+
+        return sorted(matches, key=lambda game_id: self.normalized_titles[game_id])
+
+    def suggest(self, query: str, limit: int = 5) -> [str]:
+        # Closest titles by trigram similarity, typos included
+        query_trigrams = trigrams(normalize_title(query))
+
+        with self.lock:
+            shared = collections.Counter()
+            for trigram in query_trigrams:
+                shared.update(self.trigram_index.get(trigram, ()))
+
+            scores = []
+            for game_id, count in shared.items():
+                title_trigrams = len(trigrams(self.normalized_titles[game_id]))
+                scores.append((count / (len(query_trigrams) + title_trigrams - count), self.games[game_id].title))
+
+        return [title for _, title in sorted(scores, reverse=True)[:limit]]
+
+    def rank(self, query: str, game_ids: [int]) -> [int]:
+        # game_ids by trigram similarity of their titles to the query, closest first
+        query_trigrams = trigrams(normalize_title(query))
+
+        with self.lock:
+            scores = []
+            for game_id in game_ids:
+                title_trigrams = trigrams(self.normalized_titles[game_id])
+                shared = len(query_trigrams & title_trigrams)
+                scores.append((-shared / (len(query_trigrams) + len(title_trigrams) - shared), self.normalized_titles[game_id], game_id))
+
+        return [game_id for _, _, game_id in sorted(scores)]
+
+    def search(self, query: str, currency: str) -> {str: {str: str}}:
+        # Same shape as eShop_Prices.search, or None when the catalog can't be trusted to answer
+        game_id = self.ids_by_normalized_title.get(normalize_title(query))
+        if game_id is not None:
+            game_ids = [game_id]
+        elif self.complete:
+            game_ids = self.match(query)
+            if len(game_ids) > self.max_results:
+                # A short word matches most of the catalog, which would make a keyboard too big for Telegram to send
+                game_ids = self.rank(query, game_ids)[:self.max_results]
+        else:
+            game_ids = []
+
+        results = {}
+        for game_id in game_ids:
+            best_price = self.best_prices.get(game_id, {}).get(currency)
+            if best_price is None and len(game_ids) > 1:
+                # Several results are shown with their best price, which we don't have in this currency
+                game_ids = []
+                break
+            results[self.games[game_id].title] = {
+                'best_price': best_price if best_price is not None else '',
+                'uri': self.games[game_id].uri
+            }
+
+        if len(game_ids) == 0:
+            self.local_misses += 1
+            return None
+
+        self.local_hits += 1
+        return results
+
+    def crawl(self, scraper, pages: int = 10) -> int:
+        # Walks the listing a few pages per call, wrapping around once the last page has been reached
+        crawled = 0
+        for _ in range(pages):
+            results = scraper.get_games_page(self.crawl_page)
+            if isinstance(results, str):
+                logger.warning('Stopped crawling: %s', results)
+                break
+
+            crawled += 1
+            if len(results) == 0:
+                self.crawl_page = 1
+                self.complete = True
+                break
+
+            self.add_results(results, scraper.currency)
+            self.crawl_page += 1
+
+        return crawled
+
+    def get(self, game_id: int) -> Game:
+        # None for games neither in memory nor in the loader
+        game = self.games.get(game_id)
+        if game is not None or self.loader is None or not isinstance(game_id, int):
+            return game
+
+        row = self.loader(game_id)
+        if row is None:
+            return None
+
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None:
+                game = Game(game_id, sys.intern(row[0]), row[1])
+                self.__store(game)
+
+        return game
+
+    def intern(self, game_id: int) -> int:
+        # The id object held by the catalog, so every chat favoriting a game points at the same int
+        game = self.get(game_id)
+        return game.id if game is not None else game_id
+
+    def title(self, game_id: int) -> str:
+        game = self.get(game_id)
+        return game.title if game is not None else None
+
+    def uri(self, game_id: int) -> str:
+        game = self.get(game_id)
+        return game.uri if game is not None else None
+
+    def find(self, game_title: str) -> int:
+        return self.ids_by_title.get(game_title)
+
+    def __contains__(self, game_id: int) -> bool:
+        return self.get(game_id) is not None
+
+    def __len__(self):
+        return len(self.games)
+
+    def take_changes(self) -> [Game]:
+        with self.lock:
+            changed = [self.games[game_id] for game_id in self.new_games]
+            self.new_games = set()
+
+        return changed
+
+    def restore(self, games: [(int, str, str)]):
+        with self.lock:
+            for game_id, game_title, game_uri in games:
+                self.__store(Game(game_id, sys.intern(game_title), game_uri))
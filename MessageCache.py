@@ -0,0 +1,49 @@
+import threading
+import collections
+
+class MessageCache:
+    # Rendered message bodies, so the same prices (or top discounts) asked for by many chats are rendered once.
+    # Each body remembers the data it was rendered from and is only served for that very object: the scraper hands out
+    # the same object for as long as its data is unchanged, so new prices get rendered again on their first request.
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+
+        # key -> (data, body), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, data, render, *args) -> str:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is data:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Rendered outside the lock, two chats missing at once just render the same body twice
+        body = render(*args)
+
+        with self.lock:
+            self.entries[key] = (data, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return body
+
+    def stats(self) -> {str: int}:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,147 @@
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import http.server
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histograms' buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+NO_TIMER = contextlib.nullcontext()
+
+class Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str, labels: tuple):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics._observe(self.name, self.labels, time.perf_counter() - self.start)
+
+class Metrics:
+    # Counters and latency histograms for the hot paths, kept in memory and rendered in the Prometheus text format
+    # (render(), or serve() for a /metrics endpoint). Gauges are read from stats() functions registered with collect()
+    # when rendering. Metrics(enabled=False) makes every call return right away.
+    def __init__(self, enabled: bool = True, buckets: (float,) = BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket (the last one for +Inf), sum]
+        self.collectors = []  # (prefix, stats function)
+
+        self.server = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+
+        self._observe(name, tuple(labels.items()), seconds)
+
+    def _observe(self, name: str, labels: tuple, seconds: float):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [0] * (len(self.buckets) + 2)
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    def timer(self, name: str, **labels):
+        # with metrics.timer('eshop_fetch_seconds', page='prices'): ...
+        if not self.enabled:
+            return NO_TIMER
+
+        return Timer(self, name, tuple(labels.items()))
+
+    def collect(self, prefix: str, stats):
+        # stats() -> {str: number}, reported as gauges named prefix_key (None values are left out)
+        self.collectors.append((prefix, stats))
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), histogram):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {histogram[-1]}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+
+        for prefix, stats in self.collectors:
+            for key, value in stats().items():
+                if value is None:
+                    continue
+                lines.append(f'# TYPE {prefix}_{key} gauge')
+                lines.append(f'{prefix}_{key} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host: str = '127.0.0.1', port: int = 9100):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('Serving metrics on %s:%d/metrics', host, self.server.server_port)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+def _labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
@@ -0,0 +1,227 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+import collections
+
+import requests
+
+from Metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class OutgoingCall:
+    __slots__ = ('method', 'params', 'enqueued_at', 'attempts', 'requeued')
+
+    def __init__(self, method: str, params: dict):
+        self.method = method
+        self.params = params
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.requeued = False  # put back after a 429 or an error, attempts doesn't count 429s
+
+class Outbox:
+    # Every Bot API call that sends something to a chat goes through here. Calls to the same chat go out in the order
+    # they were made, and messages are spaced to stay under Telegram's limits (about 30 per second overall and one per
+    # second per chat) rather than running into 429s. Failed calls are retried, waiting retry_after when Telegram asks.
+    THROTTLED_METHODS = ('sendMessage', 'editMessageText')
+
+    def __init__(self, session: requests.Session, base_url: str, timeout: float = 15, workers: int = 4, global_rate: float = 30, chat_rate: float = 1,
+                 max_attempts: int = 4, backoff: float = 1, metrics: Metrics = None, shared_send_at=None):
+        self.session = session
+        self.base_url = base_url
+        self.timeout = timeout
+        self.global_interval = 1 / global_rate if global_rate > 0 else 0
+        self.chat_interval = 1 / chat_rate if chat_rate > 0 else 0
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+        self.condition = threading.Condition()
+        self.chat_queues = {}  # chat_id -> deque of OutgoingCall, kept while the chat has calls queued or in flight
+        self.ready = []  # heap of (send_at, seq, chat_id) for chats with queued calls and none in flight
+        self.seq = itertools.count()
+        self.chat_send_at = {}  # chat_id -> earliest time of its next message, for chats whose queue has emptied
+        self.global_send_at = 0
+
+        # A multiprocessing.Value('d') shared by several processes' outboxes (ShardedBot's shards) makes global_rate a
+        # limit for all of them together. time.monotonic() is the same clock in every process.
+        self.shared_send_at = shared_send_at
+        self.pending = 0
+        self.running = True
+
+        self.sent = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=1000)  # seconds from enqueue() to Telegram accepting the call
+
+        self.threads = [threading.Thread(target=self.__work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, chat_id: int, method: str, params: dict):
+        with self.condition:
+            queue = self.chat_queues.get(chat_id)
+            if queue is None:
+                queue = self.chat_queues[chat_id] = collections.deque()
+                heapq.heappush(self.ready, (self.chat_send_at.pop(chat_id, 0), next(self.seq), chat_id))
+
+            queue.append(OutgoingCall(method, params))
+            self.pending += 1
+            self.condition.notify()
+
+    def __next_call(self) -> (int, OutgoingCall, float):
+        # Waits for the chat whose next call may go out first, returns None once closed and drained
+        with self.condition:
+            while True:
+                if not self.running and self.pending == 0:
+                    return None
+
+                if len(self.ready) == 0:
+                    self.condition.wait()
+                    continue
+
+                now = time.monotonic()
+                chat_send_at, _, chat_id = self.ready[0]
+                call = self.chat_queues[chat_id][0]
+                throttled = call.method in self.THROTTLED_METHODS
+
+                # Only first attempts of unthrottled calls skip the chat's spacing, retries always wait out the
+                # retry_after or backoff that __work put in chat_send_at
+                send_at = chat_send_at if throttled or call.requeued else now
+                if throttled and send_at <= now:
+                    send_at = self.__take_global_slot(now)
+                if send_at > now:
+                    self.condition.wait(send_at - now)
+                    continue
+
+                heapq.heappop(self.ready)
+                self.chat_queues[chat_id].popleft()
+                if throttled:
+                    chat_send_at = now + self.chat_interval
+
+                return chat_id, call, chat_send_at
+
+    def __take_global_slot(self, now: float) -> float:
+        # Returns now if a message may go out now (and takes its slot), otherwise when the next slot opens
+        if self.shared_send_at is not None:
+            with self.shared_send_at.get_lock():
+                if self.shared_send_at.value > now:
+                    return self.shared_send_at.value
+                self.shared_send_at.value = now + self.global_interval
+                return now
+
+        if self.global_send_at > now:
+            return self.global_send_at
+        self.global_send_at = now + self.global_interval
+        return now
+
+    def __work(self):
+        while True:
+            next_call = self.__next_call()
+            if next_call is None:
+                return
+            chat_id, call, chat_send_at = next_call
+
+            with self.metrics.timer('telegram_send_seconds', method=call.method):
+                outcome, retry_after = self.__send(call)
+            self.metrics.inc('telegram_calls_total', method=call.method, outcome=outcome)
+
+            with self.condition:
+                if outcome == 'sent':
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - call.enqueued_at)
+                elif outcome == 'failed':
+                    self.failed += 1
+                elif outcome == 'rate_limited':
+                    self.rate_limited += 1
+                else:
+                    self.retried += 1
+
+                queue = self.chat_queues[chat_id]
+                if retry_after is not None:
+                    # Goes back to the front so the chat's calls stay in order
+                    queue.appendleft(call)
+                    call.requeued = True
+                    chat_send_at = max(chat_send_at, time.monotonic() + retry_after)
+                else:
+                    self.pending -= 1
+
+                if len(queue) == 0:
+                    del self.chat_queues[chat_id]
+                    if chat_send_at > time.monotonic():
+                        self.chat_send_at[chat_id] = chat_send_at
+                else:
+                    heapq.heappush(self.ready, (chat_send_at, next(self.seq), chat_id))
+
+                self.condition.notify_all()
+
+    def __send(self, call: OutgoingCall) -> (str, float):
+        # Returns the outcome and, when the call should be tried again, how many seconds to wait first
+        call.attempts += 1
+        try:
+            # POST with a JSON body, long HTML messages don't fit in a query string
+            response = self.session.post(f'{self.base_url}/{call.method}', json=call.params, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logger.warning('Error calling %s: %s', call.method, e)
+            return self.__retry(call)
+
+        if response.status_code == 200:
+            return 'sent', None
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+
+        if response.status_code == 429:
+            # Being told to slow down doesn't count as a failed attempt
+            call.attempts -= 1
+            return 'rate_limited', float(body.get('parameters', {}).get('retry_after', self.backoff))
+
+        if response.status_code >= 500:
+            logger.warning('Error calling %s: status %d', call.method, response.status_code)
+            return self.__retry(call)
+
+        logger.error('Error calling %s: %s', call.method, body.get('description', response.status_code))
+        return 'failed', None
+
+    def __retry(self, call: OutgoingCall) -> (str, float):
+        if call.attempts >= self.max_attempts:
+            return 'failed', None
+
+        return 'retried', self.backoff * 2 ** (call.attempts - 1)
+
+    def close(self, timeout: float = None) -> int:
+        # Stops taking new work once everything queued has been sent (or timeout passes), returns the calls left unsent
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+            while self.pending > 0:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    logger.warning('Dropping %d unsent Telegram calls', self.pending)
+                    break
+                self.condition.wait(remaining)
+
+            return self.pending
+
+    def stats(self) -> {str: float}:
+        with self.condition:
+            latencies = sorted(self.latencies)
+            stats = {
+                'queued': self.pending,
+                'chats': len(self.chat_queues),
+                'sent': self.sent,
+                'retried': self.retried,
+                'rate_limited': self.rate_limited,
+                'failed': self.failed
+            }
+
+        for p in (50, 90, 99):
+            stats[f'latency_p{p}_ms'] = latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000 if len(latencies) > 0 else None
+
+        return stats
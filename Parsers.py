@@ -0,0 +1,272 @@
+import bs4
+import logging
+import lxml.html
+import lxml.etree
+
+from Price import Price
+
+logger = logging.getLogger(__name__)
+
+def _class_strainer(tag_name: str, class_name: str) -> bs4.SoupStrainer:
+    # The class attribute may not be split into a list yet when the strainer runs, so match on the tokens ourselves
+    def has_class(value) -> bool:
+        if value is None:
+            return False
+        return class_name in (value.split() if isinstance(value, str) else value)
+
+    return bs4.SoupStrainer(tag_name, class_=has_class)
+
+class SoupParser:
+    name = 'soup'
+
+    def _soup(self, text: str, parse_only: bs4.SoupStrainer = None) -> bs4.BeautifulSoup:
+        return bs4.BeautifulSoup(text, 'lxml')
+
+    def __parse_games_list_item(self, games_list_item: bs4.element.Tag) -> {str: object}:
+        game_title = games_list_item.find_all('h5')[0].string
+        game_url = games_list_item['href']
+        price_tag_strings = list(games_list_item.find_all('span', {'class': 'price-tag'})[0].strings)
+        logger.debug('Price tag strings of %s: %s', game_url, price_tag_strings)
+        try:
+            game_price = Price.parse(price_tag_strings[2].strip(), price_tag_strings[0].strip())
+        except IndexError:
+            game_price = Price.parse(price_tag_strings[0].strip())
+
+        return {
+            'game_title': game_title,
+            'game_uri': game_url,
+            'game_price': game_price
+        }
+
+    def __parse_country_column(self, country_column: bs4.element.Tag) -> (str, str):
+        country_code = country_column.find('span', {'class': 'country-code'})
+        country_code = country_code.string.strip() if country_code is not None else None
+        try:
+            return list(country_column.strings)[3].strip(), country_code
+        except IndexError:
+            return list(country_column.strings)[0].strip(), country_code
+
+    def __parse_price_column(self, price_column: bs4.element.Tag) -> (str, str):
+        # (current price, original price) as shown, the original price only when discounted
+        try:
+            original_price = price_column.div.find('del').string.strip()
+            discounted_price = list(price_column.div.strings)[2].strip()
+            return discounted_price, original_price
+        except AttributeError:
+            return price_column.string.strip(), None
+
+    def __parse_prices_table_row(self, row: bs4.element.Tag) -> Price:
+        columns = row.find_all('td')
+
+        country, country_code = self.__parse_country_column(columns[1])
+        try:
+            meta = columns[2].span['title']
+            badge = columns[2].span.string
+        except TypeError:
+            meta = None
+            badge = None
+        current_price, original_price = self.__parse_price_column(columns[3])
+
+        return Price.parse(current_price, original_price, country, country_code, badge, meta)
+
+    def parse_prices_table(self, text: str) -> [Price]:
+        soup = self._soup(text, _class_strainer('table', 'prices-table'))
+
+        prices_table = soup.find_all('table', {'class': 'prices-table'})[0]
+
+        prices = []
+        for row in prices_table.tbody.find_all('tr'):
+            try:
+                prices.append(
+                    self.__parse_prices_table_row(row)
+                )
+            except IndexError as e:
+                logger.warning('Could not parse prices table row %s: %s', row, e)
+
+        return prices
+
+    def iter_prices_table(self, chunks, encoding: str = None) -> [Price]:
+        # No incremental parsing here, the whole page is read first
+        text = b''.join(chunks)
+        yield from self.parse_prices_table(text.decode(encoding, 'replace') if encoding is not None else text)
+
+    def parse_games_list(self, text: str) -> [{str: object}]:
+        soup = self._soup(text, _class_strainer('a', 'games-list-item'))
+
+        return [self.__parse_games_list_item(games_list_item) for games_list_item in soup.find_all('a', {'class': 'games-list-item'})]
+
+    def parse_currency_select(self, text: str) -> {str: str}:
+        soup = self._soup(text, bs4.SoupStrainer('select', {'name': 'language-select'}))
+
+        currency_select = soup.find_all('select', {'name': 'language-select'})[0]
+        options = currency_select.find_all('option')
+
+        result = {}
+        for option in options:
+            result[option['value']] = option.string
+
+        return result
+
+class StrainedSoupParser(SoupParser):
+    # Same tree walking as SoupParser, but only the table/list we are after gets built
+    name = 'strainer'
+
+    def _soup(self, text: str, parse_only: bs4.SoupStrainer = None) -> bs4.BeautifulSoup:
+        return bs4.BeautifulSoup(text, 'lxml', parse_only=parse_only)
+
+def _has_class(class_name: str) -> str:
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+def _strings(element) -> [str]:
+    # Equivalent of bs4's Tag.strings: every text node below element, in document order
+    return element.xpath('.//text()')
+
+def _string(element) -> str:
+    # Equivalent of bs4's Tag.string: the only string inside element (following single children down), or None
+    children = []
+    if element.text:
+        children.append(element.text)
+    for child in element:
+        children.append(child)
+        if child.tail:
+            children.append(child.tail)
+
+    if len(children) != 1:
+        return None
+    if isinstance(children[0], str):
+        return children[0]
+    return _string(children[0])
+
+class LxmlParser:
+    # Walks the lxml tree directly with XPath, producing the same records as SoupParser.
+    # Pages it can't make sense of are handed to the SoupStrainer based parser instead.
+    name = 'lxml'
+
+    prices_table_xpath = f'//table[{_has_class("prices-table")}]'
+    games_list_item_xpath = f'//a[{_has_class("games-list-item")}]'
+    price_tag_xpath = f'.//span[{_has_class("price-tag")}]'
+
+    def __init__(self):
+        self.fallback = StrainedSoupParser()
+
+    def __parse_games_list_item(self, games_list_item) -> {str: object}:
+        game_title = _string(games_list_item.xpath('.//h5')[0])
+        game_url = games_list_item.attrib['href']
+        price_tag_strings = _strings(games_list_item.xpath(self.price_tag_xpath)[0])
+        logger.debug('Price tag strings of %s: %s', game_url, price_tag_strings)
+        try:
+            game_price = Price.parse(price_tag_strings[2].strip(), price_tag_strings[0].strip())
+        except IndexError:
+            game_price = Price.parse(price_tag_strings[0].strip())
+
+        return {
+            'game_title': game_title,
+            'game_uri': game_url,
+            'game_price': game_price
+        }
+
+    def __parse_country_column(self, country_column) -> (str, str):
+        country_code = country_column.xpath(f'.//span[{_has_class("country-code")}]')
+        country_code = _string(country_code[0]).strip() if len(country_code) > 0 and _string(country_code[0]) is not None else None
+        country_strings = _strings(country_column)
+        try:
+            return country_strings[3].strip(), country_code
+        except IndexError:
+            return country_strings[0].strip(), country_code
+
+    def __parse_price_column(self, price_column) -> (str, str):
+        div = price_column.find('.//div')
+        deleted = div.find('.//del') if div is not None else None
+        if deleted is not None and _string(deleted) is not None:
+            return _strings(div)[2].strip(), _string(deleted).strip()
+
+        return _string(price_column).strip(), None
+
+    def __parse_prices_table_row(self, row) -> Price:
+        columns = row.xpath('.//td')
+
+        country, country_code = self.__parse_country_column(columns[1])
+        span = columns[2].find('.//span')
+        meta = span.attrib['title'] if span is not None else None
+        badge = _string(span) if span is not None else None
+        current_price, original_price = self.__parse_price_column(columns[3])
+
+        return Price.parse(current_price, original_price, country, country_code, badge, meta)
+
+    def parse_prices_table(self, text: str) -> [Price]:
+        try:
+            prices_table = lxml.html.fromstring(text).xpath(self.prices_table_xpath)[0]
+            rows = prices_table.find('.//tbody').xpath('.//tr')
+        except (IndexError, AttributeError, ValueError):
+            return self.fallback.parse_prices_table(text)
+
+        prices = []
+        for row in rows:
+            try:
+                prices.append(
+                    self.__parse_prices_table_row(row)
+                )
+            except IndexError as e:
+                logger.warning('Could not parse prices table row %s: %s', lxml.html.tostring(row, encoding='unicode'), e)
+
+        return prices
+
+    def iter_prices_table(self, chunks, encoding: str = None) -> [Price]:
+        # Fed the page as it is downloaded: every row is yielded as soon as its </tr> comes in, and nothing past the
+        # end of the table is read. Elements closed before the table are emptied right away, so the page never
+        # exists as a whole tree. Pages without a prices table are handed whole to the fallback parser.
+        parser = lxml.etree.HTMLPullParser(events=('start', 'end'), encoding=encoding)
+        received = []  # Only kept until the table shows up
+        prices_table = None
+        in_body = False
+
+        for chunk in chunks:
+            if received is not None:
+                received.append(chunk)
+            parser.feed(chunk)
+
+            for event, element in parser.read_events():
+                if prices_table is None:
+                    if event == 'start' and element.tag == 'table' and 'prices-table' in element.get('class', '').split():
+                        prices_table = element
+                        received = None
+                    elif event == 'end':
+                        element.clear()
+                elif element.tag == 'tbody':
+                    in_body = event == 'start'
+                elif event == 'end' and element.tag == 'tr' and in_body:
+                    try:
+                        yield self.__parse_prices_table_row(element)
+                    except IndexError as e:
+                        logger.warning('Could not parse prices table row %s: %s', lxml.html.tostring(element, encoding='unicode'), e)
+                    element.clear()
+                elif event == 'end' and element is prices_table:
+                    return
+
+        if prices_table is None:
+            yield from self.fallback.parse_prices_table(b''.join(received))
+
+    def parse_games_list(self, text: str) -> [{str: object}]:
+        try:
+            return [self.__parse_games_list_item(games_list_item) for games_list_item in lxml.html.fromstring(text).xpath(self.games_list_item_xpath)]
+        except (IndexError, KeyError, ValueError):
+            return self.fallback.parse_games_list(text)
+
+    def parse_currency_select(self, text: str) -> {str: str}:
+        try:
+            currency_select = lxml.html.fromstring(text).xpath('//select[@name="language-select"]')[0]
+        except (IndexError, ValueError):
+            return self.fallback.parse_currency_select(text)
+
+        result = {}
+        for option in currency_select.xpath('.//option'):
+            result[option.attrib['value']] = _string(option)
+
+        return result
+
+PARSERS = {
+    parser.name: parser for parser in (SoupParser, StrainedSoupParser, LxmlParser)
+}
+
+def get_parser(name: str = 'lxml'):
+    return PARSERS[name]()
@@ -0,0 +1,149 @@
+import re
+import datetime
+
+from PricesCache import parse_sale_end
+
+# ISO code -> (symbol eshop-prices.com shows prices with, whether it writes them with a decimal comma (and thousands
+# dots), decimals the currency is written with)
+CURRENCIES = {
+    'ARS': ('ARS$', False, 2), 'AUD': ('A$', False, 2), 'BRL': ('R$', True, 2), 'CAD': ('CA$', False, 2), 'CHF': ('CHF', False, 2),
+    'CLP': ('CLP$', True, 0), 'COP': ('COL$', True, 0), 'CZK': ('Kč', True, 2), 'DKK': ('kr.', True, 2), 'EUR': ('€', True, 2),
+    'GBP': ('£', False, 2), 'HKD': ('HK$', False, 2), 'HUF': ('Ft', False, 0), 'JPY': ('¥', False, 0), 'KRW': ('₩', False, 0),
+    'MXN': ('MX$', False, 2), 'NOK': ('kr', True, 2), 'NZD': ('NZ$', False, 2), 'PEN': ('S/', False, 2), 'PLN': ('zł', True, 2),
+    'RUB': ('₽', False, 2), 'SEK': ('kr', True, 2), 'USD': ('$', False, 2), 'ZAR': ('R', False, 2)
+}
+
+# Currency of each country's own eShop
+COUNTRY_CURRENCIES = {
+    'AR': 'ARS', 'AT': 'EUR', 'AU': 'AUD', 'BE': 'EUR', 'BR': 'BRL', 'CA': 'CAD', 'CH': 'CHF', 'CL': 'CLP', 'CO': 'COP',
+    'CZ': 'CZK', 'DE': 'EUR', 'DK': 'DKK', 'ES': 'EUR', 'FI': 'EUR', 'FR': 'EUR', 'GB': 'GBP', 'GR': 'EUR', 'HK': 'HKD',
+    'HU': 'HUF', 'IE': 'EUR', 'IT': 'EUR', 'JP': 'JPY', 'KR': 'KRW', 'LU': 'EUR', 'MX': 'MXN', 'NL': 'EUR', 'NO': 'NOK',
+    'NZ': 'NZD', 'PE': 'PEN', 'PL': 'PLN', 'PT': 'EUR', 'RU': 'RUB', 'SE': 'SEK', 'US': 'USD', 'ZA': 'ZAR'
+}
+
+SYMBOL_CURRENCIES = {}
+for code, (symbol, _, _) in CURRENCIES.items():
+    SYMBOL_CURRENCIES.setdefault(symbol, []).append(code)
+
+def currency_decimals(currency: str) -> int:
+    # Unknown currencies are taken to have cents
+    return CURRENCIES[currency][2] if currency in CURRENCIES else 2
+
+def round_amount(amount: int, currency: str) -> int:
+    # Hundredths rounded to what the currency is written with, 123456 JPY -> 123500
+    if amount is None:
+        return None
+
+    unit = 10 ** (2 - currency_decimals(currency))
+    return round(amount / unit) * unit
+
+def parse_amount(price_text: str, currency: str = None) -> int:
+    # 'Kč 1.234,56' -> 123456, 'MX$ 37.70' -> 3770, '¥ 1,200' -> 120000 (hundredths of the currency).
+    # Currencies without decimals only have thousands separators, 'CLP$ 42.99' is 4299 pesos
+    digits = re.sub('[^0-9.,]', '', price_text or '')
+    if not re.search('\\d', digits):
+        return None
+
+    if currency_decimals(currency) == 0:
+        return int(re.sub('[^0-9]', '', digits)) * 100
+
+    m = re.match('(.*?)(?:[.,](\\d{1,2}))?$', digits)
+    whole = re.sub('[^0-9]', '', m.group(1))
+    fraction = (m.group(2) or '').ljust(2, '0')
+
+    return int(whole or 0) * 100 + int(fraction)
+
+def parse_currency(price_text: str, country_code: str = None) -> str:
+    # 'R$ 199,90' -> 'BRL'. Symbols shared by several currencies ('kr') go by the country, unknown symbols are kept as they are.
+    symbol = re.split('\\s*\\d', (price_text or '').strip(), 1)[0]
+    codes = SYMBOL_CURRENCIES.get(symbol, [])
+    if len(codes) == 0:
+        return symbol
+    if COUNTRY_CURRENCIES.get(country_code) in codes:
+        return COUNTRY_CURRENCIES[country_code]
+
+    return codes[0]
+
+def format_amount(amount: int, currency: str) -> str:
+    # 123456, 'BRL' -> 'R$ 1.234,56', 123456, 'JPY' -> '¥ 1,235'
+    if amount is None:
+        return ''
+
+    symbol, decimal_comma, decimals = CURRENCIES.get(currency, (currency, False, 2))
+    if decimals == 0:
+        number = f'{round(amount / 100):,}'
+    else:
+        number = f'{amount // 100:,}.{amount % 100:02d}'
+    if decimal_comma:
+        number = number.replace(',', ' ').replace('.', ',').replace(' ', '.')
+
+    return f'{symbol} {number}'.strip()
+
+class Price:
+    # One country's price for a game, or a games list entry's best price (no country). Amounts are ints in hundredths
+    # of the currency (an ISO code when it could be told from the symbol), discount is a percentage.
+    __slots__ = ('country', 'country_code', 'amount', 'original_amount', 'currency', 'discount', 'sale_end')
+
+    def __init__(self, country: str, country_code: str, amount: int, original_amount: int, currency: str, discount: int = 0, sale_end: datetime.datetime = None):
+        self.country = country
+        self.country_code = country_code
+        self.amount = amount
+        self.original_amount = original_amount
+        self.currency = currency
+        self.discount = discount
+        self.sale_end = sale_end
+
+    @staticmethod
+    def parse(current_price: str, original_price: str = None, country: str = None, country_code: str = None, badge: str = None, meta: str = None) -> 'Price':
+        # From the strings on the page: 'R$ 139,93', 'R$ 199,90', 'Brazil', 'BR', '-30%', 'On sale until Feb. 10, 2031'
+        currency = parse_currency(current_price, country_code)
+        amount = parse_amount(current_price, currency)
+        original_amount = parse_amount(original_price, currency) if original_price is not None else amount
+
+        discount = 0
+        if original_price is not None:
+            m = re.search('(\\d+)\\s*%', badge or '')
+            if m is not None:
+                discount = int(m.group(1))
+            elif amount is not None and original_amount:
+                discount = round(100 - amount * 100 / original_amount)
+
+        return Price(country, country_code, amount, original_amount, currency, discount, parse_sale_end(meta))
+
+    @property
+    def on_sale(self) -> bool:
+        return self.discount > 0 or (self.amount is not None and self.original_amount is not None and self.amount < self.original_amount)
+
+    def json(self) -> list:
+        return [
+            self.country, self.country_code, self.amount, self.original_amount, self.currency, self.discount,
+            self.sale_end.isoformat() if self.sale_end is not None else None
+        ]
+
+    @staticmethod
+    def load(dump: list) -> 'Price':
+        sale_end = datetime.datetime.fromisoformat(dump[6]) if dump[6] is not None else None
+        return Price(*dump[:6], sale_end)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Price) and self.json() == other.json()
+
+    def __hash__(self) -> int:
+        return hash(tuple(self.json()))
+
+    def __str__(self) -> str:
+        return format_amount(self.amount, self.currency)
+
+    def __repr__(self) -> str:
+        return f'Price({", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)})'
+
+def json_default(value):
+    # json.dumps(..., default=json_default) for values holding Price records, json_object_hook turns them back
+    if isinstance(value, Price):
+        return {'__price__': value.json()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def json_object_hook(dct: dict):
+    if len(dct) == 1 and '__price__' in dct:
+        return Price.load(dct['__price__'])
+    return dct
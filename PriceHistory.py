@@ -0,0 +1,89 @@
+import json
+import time
+import hashlib
+import collections
+
+from Price import Price, format_amount, parse_currency
+
+PriceRun = collections.namedtuple('PriceRun', ['country', 'first_seen', 'last_seen', 'price', 'price_text', 'discount', 'currency'])
+
+DAY = 24 * 60 * 60
+
+def price_table_hash(prices: [Price]) -> str:
+    # Same hash for the same prices, whatever order the rows were scraped in
+    rows = sorted((json.dumps(price.json()) for price in prices))
+    return hashlib.sha1(json.dumps(rows).encode()).hexdigest()
+
+class PriceHistory:
+    # Every scraped prices table is recorded per (game, currency, country) as runs of an unchanged price: a scrape that
+    # finds the same price only moves the run's last_seen, so a game that never changes price costs one row per country.
+    # compact() merges old runs into one per day, then one per week, keeping the lowest price of each.
+    LEVELS = ((30 * DAY, DAY), (365 * DAY, 7 * DAY))  # (older than, merge into buckets of)
+
+    def __init__(self, store):
+        self.store = store
+
+    def record(self, game_id: int, currency: str, prices: [Price], now: float = None) -> [str]:
+        # Returns the countries whose price (or discount) changed since the last snapshot
+        now = time.time() if now is None else now
+        latest = {run.country: run for run in self.latest(game_id, currency)}
+
+        extended_runs = []
+        new_runs = []
+        changed = []
+        for row in prices:
+            price = row.amount
+            discount = row.on_sale
+
+            run = latest.get(row.country)
+            if run is not None and run.price == price and run.discount == discount:
+                extended_runs.append((game_id, currency, run.country, run.first_seen))
+            else:
+                new_runs.append((game_id, currency, row.country, now, now, price, format_amount(price, row.currency), discount, row.currency))
+                changed.append(row.country)
+
+        self.store.save_price_runs(extended_runs, new_runs, now)
+
+        return changed
+
+    def latest(self, game_id: int, currency: str) -> [PriceRun]:
+        return [PriceRun(*run) for run in self.store.load_price_runs(game_id, currency, latest_only=True)]
+
+    def runs(self, game_id: int, currency: str) -> [PriceRun]:
+        return [PriceRun(*run) for run in self.store.load_price_runs(game_id, currency)]
+
+    def summary(self, game_id: int, currency: str) -> [{str: object}]:
+        # Per country: the current price and the lowest one ever seen. Sorted by country, every country is in its own
+        # currency so the amounts can't be compared without converting them.
+        runs_by_country = {}
+        for run in self.runs(game_id, currency):
+            runs_by_country.setdefault(run.country, []).append(run)
+
+        summary = []
+        for country, runs in runs_by_country.items():
+            current = max(runs, key=lambda run: run.first_seen)
+            lowest = min((run for run in runs if run.price is not None), key=lambda run: (run.price, run.first_seen), default=current)
+            summary.append({
+                'country': country,
+                # Runs recorded before their currency was kept only have it in the text
+                'currency': current.currency or parse_currency(current.price_text),
+                'current_price': current.price,
+                'current_price_text': current.price_text,
+                'discount': current.discount,
+                'lowest_price': lowest.price,
+                'lowest_price_text': lowest.price_text,
+                'lowest_seen': lowest.first_seen,
+                'tracked_since': min(run.first_seen for run in runs),
+                'last_seen': current.last_seen
+            })
+
+        return sorted(summary, key=lambda entry: entry['country'])
+
+    def compact(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+
+        merged = 0
+        for age, bucket in self.LEVELS:
+            merged += self.store.compact_price_runs(now - age, bucket)
+
+        return merged
@@ -0,0 +1,200 @@
+import re
+import time
+import datetime
+import threading
+import collections
+
+def parse_sale_end(meta: str) -> datetime.datetime:
+    # meta looks like 'On sale until Feb. 14, 2021' (or 'March 3, 2021', 'Sept. 9, 2021')
+    if meta is None:
+        return None
+
+    m = re.search('until (\\w+)\\.? (\\d+), (\\d+)', meta)
+    if m is None:
+        return None
+
+    try:
+        return datetime.datetime.strptime(f'{m.group(1)[:3]} {m.group(2)} {m.group(3)}', '%b %d %Y')
+    except ValueError:
+        return None
+
+def prices_sale_end(prices: ['Price']) -> datetime.datetime:
+    sale_ends = [price.sale_end for price in prices if price.on_sale and price.sale_end is not None]
+
+    return min(sale_ends) if len(sale_ends) > 0 else None
+
+class PricesCache:
+    # Part of every key, bumped whenever the shape of what gets cached changes so entries persisted before aren't read back
+    FORMAT = 2
+
+    def __init__(self, max_entries: int = 2000, ttl: int = 12 * 60 * 60, loader=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Optional loader(key) -> (value, expires_at) or None, consulted on misses (e.g. entries persisted by a StateStore)
+        self.loader = loader
+
+        # key -> (value, expires_at), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.loads = 0
+
+        # Keys written or dropped since the last take_changes(), so only those need persisting
+        self.changed_keys = set()
+        self.removed_keys = set()
+
+    @staticmethod
+    def prices_key(game_uri: str, currency: str) -> str:
+        return f'prices|{PricesCache.FORMAT}|{currency.upper()}|{game_uri.strip("/")}'
+
+    @staticmethod
+    def search_key(query: str, currency: str) -> str:
+        normalized_query = ' '.join(query.lower().split())
+        return f'search|{PricesCache.FORMAT}|{currency.upper()}|{normalized_query}'
+
+    @staticmethod
+    def top_discounts_key(currency: str) -> str:
+        return f'top_discounts|{PricesCache.FORMAT}|{currency.upper()}'
+
+    @staticmethod
+    def validators_key(request_url: str) -> str:
+        return f'validators|{PricesCache.FORMAT}|{request_url}'
+
+    def get(self, key: str):
+        with self.lock:
+            try:
+                value, expires_at = self.entries[key]
+            except KeyError:
+                value, expires_at = None, None
+            else:
+                if expires_at <= time.time():
+                    self.__expire(key)
+                    self.expirations += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+        entry = self.loader(key) if self.loader is not None else None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.loads += 1
+            self.removed_keys.discard(key)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.__evict()
+            return entry[0]
+
+    def expires_at(self, key: str) -> float:
+        # When the entry in memory expires (None when there is none), without counting as a lookup or touching the LRU order
+        with self.lock:
+            entry = self.entries.get(key)
+
+        return entry[1] if entry is not None else None
+
+    def put(self, key: str, value, ttl: int = None, expires_at: float = None):
+        now = time.time()
+        entry_expires_at = now + (self.ttl if ttl is None else ttl)
+        if expires_at is not None:
+            entry_expires_at = min(entry_expires_at, expires_at)
+
+        with self.lock:
+            self.entries[key] = (value, entry_expires_at)
+            self.entries.move_to_end(key)
+            self.changed_keys.add(key)
+            self.removed_keys.discard(key)
+            self.__evict()
+
+    def __evict(self):
+        # Evicted entries only leave memory, anything persisted stays loadable until it expires
+        while len(self.entries) > self.max_entries:
+            key, _ = self.entries.popitem(last=False)
+            self.changed_keys.discard(key)
+            self.evictions += 1
+
+    def __expire(self, key: str):
+        # Expired rows are deleted from the store by its own purge. Recording them as removed could delete a fresh row
+        # another process (a ShardedBot shard) has written under the same key since.
+        del self.entries[key]
+        self.changed_keys.discard(key)
+
+    def __remove(self, key: str):
+        del self.entries[key]
+        self.changed_keys.discard(key)
+        self.removed_keys.add(key)
+
+    def put_prices(self, key: str, prices: ['Price']):
+        # Discounted prices go stale as soon as the sale ends, regardless of the TTL
+        sale_end = prices_sale_end(prices)
+        if sale_end is not None:
+            self.put(key, prices, expires_at=(sale_end + datetime.timedelta(days=1)).timestamp())
+        else:
+            self.put(key, prices)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self.lock:
+            expired = [key for key, (_, expires_at) in self.entries.items() if expires_at <= now]
+            for key in expired:
+                self.__expire(key)
+            self.expirations += len(expired)
+
+        return len(expired)
+
+    def stats(self) -> {str: int}:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'loads': self.loads
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def json(self):
+        with self.lock:
+            return {
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'entries': [[key, value, expires_at] for key, (value, expires_at) in self.entries.items()]
+            }
+
+    def take_changes(self) -> ([(str, object, float)], [str]):
+        with self.lock:
+            changed = [(key, *self.entries[key]) for key in self.changed_keys]
+            removed = list(self.removed_keys)
+            self.changed_keys = set()
+            self.removed_keys = set()
+
+        return changed, removed
+
+    def restore(self, entries: [(str, object, float)]):
+        now = time.time()
+        with self.lock:
+            for key, value, expires_at in entries:
+                if expires_at > now:
+                    self.entries[key] = (value, expires_at)
+
+    @staticmethod
+    def load(dump) -> 'PricesCache':
+        cache = PricesCache(max_entries=dump['max_entries'], ttl=dump['ttl'])
+        cache.restore(dump['entries'])
+
+        return cache
@@ -0,0 +1,193 @@
+import logging
+import threading
+import multiprocessing
+
+from eShop_Prices import build_session
+from StateStore import StateStore
+from Metrics import Metrics
+from WebhookServer import WebhookServer
+from TelegramBot import TelegramBot, get_updates, set_webhook, update_chat_id
+
+logger = logging.getLogger(__name__)
+
+def run_shard(shard: int, shards: int, updates: multiprocessing.Queue, processed: multiprocessing.Queue, ready: multiprocessing.Event, shared_send_at, token: str, bot_args: dict,
+              log_level: str = 'INFO', metrics_enabled: bool = True, metrics_host: str = '127.0.0.1', metrics_port: int = None):
+    # Entry point of every shard process
+    logging.basicConfig(level=log_level, format=f'%(asctime)s %(levelname)s shard {shard} %(name)s: %(message)s')
+
+    # Each shard has its own metrics, served on metrics_port + shard
+    metrics = Metrics(enabled=metrics_enabled)
+    if metrics_port is not None and metrics.enabled:
+        metrics.serve(metrics_host, metrics_port + shard)
+
+    bot = TelegramBot(token, shard=shard, shards=shards, metrics=metrics, shared_send_at=shared_send_at, **bot_args)
+    bot.dump_state()
+    ready.set()
+
+    bot.run_queue(updates, processed)
+
+class ShardedBot:
+    # Spreads the bot over shards worker processes, so parsing pages and rendering messages use more than one core.
+    # This process only receives updates (getUpdates or a webhook) and routes each one to the shard of its chat,
+    # chat_id % shards. Every shard is a TelegramBot on the same state database, which is where they share chat state,
+    # the prices cache, promos and exchange rates.
+    def __init__(self, token: str, shards: int = 4, api_url: str = 'https://api.telegram.org', state_path: str = 'state.db', timeout: float = 15,
+                 dump_interval: float = 5, log_level: str = 'INFO', metrics_enabled: bool = True, metrics_host: str = '127.0.0.1',
+                 metrics_port: int = None, **bot_args):
+        self.token = token
+        self.base_url = f'{api_url}/bot{token}'
+        self.shards = shards
+        self.timeout = timeout
+        self.dump_interval = dump_interval
+        self.running = False
+        self.stopped = threading.Event()
+
+        self.bot_args = dict(bot_args, api_url=api_url, state_path=state_path, timeout=timeout, dump_interval=dump_interval)
+        self.shard_args = {'log_level': log_level, 'metrics_enabled': metrics_enabled, 'metrics_host': metrics_host, 'metrics_port': metrics_port}
+
+        # Spawned rather than forked, the shards start from a clean interpreter instead of a copy of this one's threads
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(shards)]
+
+        # Shards send back the id of every update they have handled, the offset only moves past those
+        self.processed = self.context.Queue()
+        self.collector = None
+
+        # Each shard has its own outbox, they take turns on Telegram's global rate limit through this
+        self.shared_send_at = self.context.Value('d', 0)
+        self.processes = []
+        self.routed = [0] * shards
+
+        self.session = build_session()
+        self.store = StateStore(state_path)
+        self.webhook = None
+
+        # Every update up to last_processed_update_id has been handled, the ones in pending are routed but not handled yet.
+        # getUpdates is only confirmed up to last_processed_update_id, Telegram forgets updates once they are confirmed,
+        # so the ones a shard didn't get to are delivered again after a restart.
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        last_processed_update_id = self.store.get_meta('last_processed_update_id')
+        self.last_processed_update_id = int(last_processed_update_id) if last_processed_update_id is not None else None
+        self.routed_update_id = self.last_processed_update_id
+        self.pending = set()
+
+    def start_shards(self):
+        # Shard 0 starts alone first, so only it imports legacy state or builds missing tables
+        for shard in range(self.shards):
+            ready = self.context.Event()
+            process = self.context.Process(
+                target=run_shard, name=f'shard-{shard}',
+                args=(shard, self.shards, self.queues[shard], self.processed, ready, self.shared_send_at, self.token, self.bot_args), kwargs=self.shard_args
+            )
+            process.start()
+            self.processes.append(process)
+
+            while not ready.wait(1):
+                if not process.is_alive():
+                    raise RuntimeError(f'Shard {shard} exited while starting (exit code {process.exitcode})')
+
+        self.collector = threading.Thread(target=self.__collect_processed, name='processed', daemon=True)
+        self.collector.start()
+        logger.info('Started %d shards', self.shards)
+
+    def stop_shards(self):
+        # Shards handle what is already queued for them before exiting
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
+        self.processed.put(None)
+        self.collector.join()
+
+        logger.info('Stopped %d shards, updates routed to each: %s', self.shards, self.routed)
+
+    def route(self, update: dict) -> bool:
+        update_id = update['update_id']
+        chat_id = update_chat_id(update)
+        with self.lock:
+            if self.routed_update_id is None or update_id > self.routed_update_id:
+                self.routed_update_id = update_id
+
+            if chat_id is None:
+                # Nothing to handle, it counts as processed right away
+                logger.debug('Skipping update %s, it is neither a message nor a callback query', update_id)
+                self.__advance()
+                return False
+
+            shard = chat_id % self.shards
+            self.pending.add(update_id)
+            self.routed[shard] += 1
+
+        self.queues[shard].put(update)
+        return True
+
+    def __routed_before(self, update: dict) -> bool:
+        # getUpdates returns the updates still being handled again until they are confirmed, it returns them in order
+        with self.lock:
+            return self.routed_update_id is not None and update['update_id'] <= self.routed_update_id
+
+    def __advance(self):
+        # Called with the lock held
+        self.last_processed_update_id = min(self.pending) - 1 if len(self.pending) > 0 else self.routed_update_id
+        self.condition.notify_all()
+
+    def __collect_processed(self):
+        while True:
+            update_id = self.processed.get()
+            if update_id is None:
+                return
+
+            with self.lock:
+                self.pending.discard(update_id)
+                self.__advance()
+
+    def save_state(self):
+        if self.last_processed_update_id is not None:
+            self.store.save(meta={'last_processed_update_id': str(self.last_processed_update_id)})
+
+    def run(self):
+        # Long polling getUpdates, like TelegramBot.run
+        self.running = True
+        self.start_shards()
+        try:
+            while self.running:
+                # Polling again while the shards still have updates queued would only return those again
+                with self.condition:
+                    self.condition.wait_for(lambda: len(self.pending) == 0, timeout=1)
+
+                for update in get_updates(self.session, self.base_url, timeout=300, last_processed_update_id=self.last_processed_update_id, request_timeout=self.timeout):
+                    if not self.__routed_before(update):
+                        self.route(update)
+
+                self.save_state()
+        except KeyboardInterrupt:
+            pass
+
+        self.stop_shards()
+        self.save_state()
+
+    def run_webhook(self, url: str = None, host: str = '0.0.0.0', port: int = 8443, path: str = '/', secret_token: str = None, max_connections: int = 40):
+        # Like TelegramBot.run_webhook, with updates routed to the shards as they arrive
+        self.webhook = WebhookServer(self.route, host=host, port=port, path=path, secret_token=secret_token)
+        if url is not None:
+            set_webhook(self.session, self.base_url, url, secret_token=secret_token, max_connections=max_connections, timeout=self.timeout)
+
+        self.running = True
+        self.start_shards()
+        self.webhook.start()
+        logger.info('Listening for webhook updates on %s:%d%s', host, self.webhook.port, path)
+        try:
+            while self.running:
+                self.stopped.wait(self.dump_interval)
+                self.save_state()
+        except KeyboardInterrupt:
+            pass
+
+        self.webhook.shutdown()
+        self.stop_shards()
+        self.save_state()
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
@@ -0,0 +1,59 @@
+import threading
+
+class Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    # Calls made with the same key while one is already running wait for it and get its result (or its exception)
+    # instead of doing the same work again
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Call in flight
+
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: str, function, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return len(self.calls)
+
+    def stats(self) -> {str: int}:
+        return {
+            'in_flight': self.in_flight(),
+            'executed': self.executed,
+            'shared': self.shared
+        }
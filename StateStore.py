@@ -0,0 +1,299 @@
+import json
+import time
+import sqlite3
+import threading
+
+from Price import json_default, json_object_hook
+
+class StateStore:
+    # SQLite (WAL mode) backed bot state. Every save() is one transaction that only touches the rows that changed,
+    # so a crash leaves either the previous or the new state on disk, never half of each.
+    def __init__(self, path: str = 'state.db', timeout: float = 30):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # Several processes (ShardedBot's shards) can share one database, a writer waits up to timeout seconds for the
+        # others' transactions. Transactions start with BEGIN IMMEDIATE so they queue up for the write lock right away.
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self.lock:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS informed_users (promo_key TEXT NOT NULL, chat_id INTEGER NOT NULL, PRIMARY KEY (promo_key, chat_id));
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS games (game_id INTEGER PRIMARY KEY, title TEXT NOT NULL, uri TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS price_history (
+                    game_id INTEGER NOT NULL, currency TEXT NOT NULL, country TEXT NOT NULL, first_seen REAL NOT NULL, last_seen REAL NOT NULL,
+                    price INTEGER, price_text TEXT, discount INTEGER NOT NULL,
+                    PRIMARY KEY (game_id, currency, country, first_seen)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    chat_id INTEGER NOT NULL, currency TEXT NOT NULL, favorite TEXT NOT NULL, threshold INTEGER, updated_at REAL NOT NULL,
+                    PRIMARY KEY (chat_id, currency, favorite)
+                );
+                CREATE INDEX IF NOT EXISTS subscriptions_by_favorite ON subscriptions (currency, favorite, updated_at);
+                CREATE TABLE IF NOT EXISTS price_hashes (currency TEXT NOT NULL, favorite TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (currency, favorite));
+            ''')
+
+            # Runs recorded before price_currency existed only have it in price_text
+            if 'price_currency' not in {row[1] for row in self.connection.execute('PRAGMA table_info(price_history)')}:
+                self.connection.execute('ALTER TABLE price_history ADD COLUMN price_currency TEXT')
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.connection.execute('SELECT NOT EXISTS (SELECT 1 FROM meta) AND NOT EXISTS (SELECT 1 FROM chats)').fetchone()[0] == 1
+
+    def save(self, chats: {int: dict} = None, cache_entries: [(str, object, float)] = (), removed_cache_keys: [str] = (),
+             informed_users: [(str, int)] = (), forgotten_promos: [str] = (), meta: {str: str} = None, games: [(int, str, str)] = (),
+             subscriptions: {int: [(str, str, int)]} = None, price_hashes: [(str, str, str)] = ()):
+        chats = chats if chats is not None else {}
+        meta = meta if meta is not None else {}
+        subscriptions = subscriptions if subscriptions is not None else {}
+
+        with self.lock:
+            try:
+                self.connection.execute('BEGIN IMMEDIATE')
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO chats (chat_id, state) VALUES (?, ?)',
+                    [(chat_id, json.dumps(state)) for chat_id, state in chats.items()]
+                )
+                self.connection.executemany(
+                    'DELETE FROM cache WHERE key = ?',
+                    [(key,) for key in removed_cache_keys]
+                )
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                    [(key, json.dumps(value, default=json_default), expires_at) for key, value, expires_at in cache_entries]
+                )
+                self.connection.executemany(
+                    'DELETE FROM informed_users WHERE promo_key = ?',
+                    [(promo_key,) for promo_key in forgotten_promos]
+                )
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO informed_users (promo_key, chat_id) VALUES (?, ?)',
+                    informed_users
+                )
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                    list(meta.items())
+                )
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO games (game_id, title, uri) VALUES (?, ?, ?)',
+                    [tuple(game) for game in games]
+                )
+                for chat_id, chat_subscriptions in subscriptions.items():
+                    self.__save_subscriptions(chat_id, chat_subscriptions)
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO price_hashes (currency, favorite, hash) VALUES (?, ?, ?)',
+                    price_hashes
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def __save_subscriptions(self, chat_id: int, chat_subscriptions: [(str, str, int)]):
+        # Only new subscriptions and changed thresholds get a new updated_at, it's how check_promos finds them
+        existing = {
+            (currency, favorite): threshold
+            for currency, favorite, threshold in self.connection.execute('SELECT currency, favorite, threshold FROM subscriptions WHERE chat_id = ?', (chat_id,))
+        }
+        current = {(currency, favorite): threshold for currency, favorite, threshold in chat_subscriptions}
+
+        self.connection.executemany(
+            'DELETE FROM subscriptions WHERE chat_id = ? AND currency = ? AND favorite = ?',
+            [(chat_id, currency, favorite) for currency, favorite in existing.keys() - current.keys()]
+        )
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO subscriptions (chat_id, currency, favorite, threshold, updated_at) VALUES (?, ?, ?, ?, ?)',
+            [(chat_id, currency, favorite, threshold, now) for (currency, favorite), threshold in current.items() if (currency, favorite) not in existing or existing[(currency, favorite)] != threshold]
+        )
+
+    def load_chat(self, chat_id: int) -> dict:
+        with self.lock:
+            row = self.connection.execute('SELECT state FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def iter_chats(self, batch_size: int = 1000) -> [(int, dict)]:
+        # Pages through the table so callers never hold every chat in memory at once
+        last_chat_id = None
+        while True:
+            with self.lock:
+                if last_chat_id is None:
+                    rows = self.connection.execute('SELECT chat_id, state FROM chats ORDER BY chat_id LIMIT ?', (batch_size,)).fetchall()
+                else:
+                    rows = self.connection.execute('SELECT chat_id, state FROM chats WHERE chat_id > ? ORDER BY chat_id LIMIT ?', (last_chat_id, batch_size)).fetchall()
+
+            for chat_id, state in rows:
+                yield chat_id, json.loads(state)
+
+            if len(rows) < batch_size:
+                return
+            last_chat_id = rows[-1][0]
+
+    def load_cache_entry(self, key: str, now: float = None) -> (object, float):
+        now = time.time() if now is None else now
+        with self.lock:
+            row = self.connection.execute('SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+
+        return (json.loads(row[0], object_hook=json_object_hook), row[1]) if row is not None else None
+
+    def purge_cache(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        with self.lock:
+            return self.connection.execute('DELETE FROM cache WHERE expires_at <= ?', (now,)).rowcount
+
+    def load_informed_users(self) -> {str: {int}}:
+        with self.lock:
+            rows = self.connection.execute('SELECT promo_key, chat_id FROM informed_users').fetchall()
+
+        informed_users = {}
+        for promo_key, chat_id in rows:
+            informed_users.setdefault(promo_key, set()).add(chat_id)
+
+        return informed_users
+
+    def load_game(self, game_id: int) -> (str, str):
+        with self.lock:
+            return self.connection.execute('SELECT title, uri FROM games WHERE game_id = ?', (game_id,)).fetchone()
+
+    def load_games(self) -> [(int, str, str)]:
+        with self.lock:
+            return self.connection.execute('SELECT game_id, title, uri FROM games').fetchall()
+
+    def save_price_runs(self, extended_runs: [(int, str, str, float)], new_runs: [(int, str, str, float, float, int, str, bool, str)], last_seen: float):
+        # extended_runs are (game_id, currency, country, first_seen) of runs whose price was seen again at last_seen
+        with self.lock:
+            try:
+                self.connection.execute('BEGIN IMMEDIATE')
+                self.connection.executemany(
+                    'UPDATE price_history SET last_seen = ? WHERE game_id = ? AND currency = ? AND country = ? AND first_seen = ?',
+                    [(last_seen,) + tuple(run) for run in extended_runs]
+                )
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO price_history (game_id, currency, country, first_seen, last_seen, price, price_text, discount, price_currency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    new_runs
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def load_price_runs(self, game_id: int, currency: str, latest_only: bool = False) -> [(str, float, float, int, str, bool, str)]:
+        query = 'SELECT country, first_seen, last_seen, price, price_text, discount, price_currency FROM price_history p WHERE game_id = ? AND currency = ?'
+        if latest_only:
+            query += ' AND first_seen = (SELECT MAX(first_seen) FROM price_history WHERE game_id = p.game_id AND currency = p.currency AND country = p.country)'
+
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY country, first_seen', (game_id, currency)).fetchall()
+
+        return [(country, first_seen, last_seen, price, price_text, bool(discount), price_currency)
+                for country, first_seen, last_seen, price, price_text, discount, price_currency in rows]
+
+    def merge_price_history(self, currency: str) -> int:
+        # Moves the runs recorded under every other currency key to currency's, runs that would collide with one already
+        # there are dropped. Returns how many runs were moved.
+        with self.lock:
+            try:
+                self.connection.execute('BEGIN IMMEDIATE')
+                moved = self.connection.execute('UPDATE OR IGNORE price_history SET currency = ? WHERE currency != ?', (currency, currency)).rowcount
+                self.connection.execute('DELETE FROM price_history WHERE currency != ?', (currency,))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        return moved
+
+    def compact_price_runs(self, before: float, bucket: float) -> int:
+        # Runs that ended before `before` are merged into one per bucket seconds, which keeps the lowest price of the bucket.
+        # The latest run of every country is left alone, it's what the next scrape gets compared to.
+        with self.lock:
+            try:
+                self.connection.execute('BEGIN IMMEDIATE')
+                rows = self.connection.execute(
+                    '''SELECT game_id, currency, country, first_seen, last_seen, price, price_text, discount, price_currency FROM price_history p
+                       WHERE last_seen < ? AND first_seen < (SELECT MAX(first_seen) FROM price_history WHERE game_id = p.game_id AND currency = p.currency AND country = p.country)
+                       ORDER BY game_id, currency, country, first_seen''',
+                    (before,)
+                ).fetchall()
+
+                groups = {}
+                for row in rows:
+                    groups.setdefault(row[:3] + (int(row[3] // bucket),), []).append(row)
+
+                removed = []
+                merged = []
+                for runs in groups.values():
+                    if len(runs) < 2:
+                        continue
+
+                    lowest = min(runs, key=lambda run: (run[5] is None, run[5] or 0))
+                    removed.extend(run[:4] for run in runs)
+                    merged.append(lowest[:3] + (runs[0][3], max(run[4] for run in runs)) + lowest[5:])
+
+                self.connection.executemany(
+                    'DELETE FROM price_history WHERE game_id = ? AND currency = ? AND country = ? AND first_seen = ?',
+                    removed
+                )
+                self.connection.executemany(
+                    'INSERT INTO price_history (game_id, currency, country, first_seen, last_seen, price, price_text, discount, price_currency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    merged
+                )
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        return len(removed) - len(merged)
+
+    def load_subscribed_favorites(self) -> {str: [str]}:
+        # currency -> favorites at least one chat is subscribed to
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT currency, favorite FROM subscriptions ORDER BY currency, favorite').fetchall()
+
+        favorites = {}
+        for currency, favorite in rows:
+            favorites.setdefault(currency, []).append(favorite)
+
+        return favorites
+
+    def load_currencies(self) -> {str}:
+        # Every currency a chat has set or has subscriptions in, whether the chat is in memory or not
+        with self.lock:
+            rows = self.connection.execute("SELECT json_extract(state, '$.currency') FROM chats UNION SELECT currency FROM subscriptions").fetchall()
+
+        return {currency for currency, in rows if currency is not None}
+
+    def load_popular_favorites(self, limit: int) -> [(str, str)]:
+        # The limit (currency, favorite) pairs with the most subscribed chats, most subscribed first
+        with self.lock:
+            return self.connection.execute(
+                'SELECT currency, favorite FROM subscriptions GROUP BY currency, favorite ORDER BY COUNT(*) DESC, currency, favorite LIMIT ?', (limit,)
+            ).fetchall()
+
+    def load_subscribers(self, currency: str, favorite: str, updated_since: float = None) -> [(int, int)]:
+        # (chat_id, threshold) of the chats subscribed to favorite, optionally only those subscribed or changed since updated_since
+        with self.lock:
+            if updated_since is None:
+                return self.connection.execute('SELECT chat_id, threshold FROM subscriptions WHERE currency = ? AND favorite = ?', (currency, favorite)).fetchall()
+            return self.connection.execute('SELECT chat_id, threshold FROM subscriptions WHERE currency = ? AND favorite = ? AND updated_at > ?', (currency, favorite, updated_since)).fetchall()
+
+    def load_price_hashes(self) -> {(str, str): str}:
+        with self.lock:
+            return {(currency, favorite): price_hash for currency, favorite, price_hash in self.connection.execute('SELECT currency, favorite, hash FROM price_hashes')}
+
+    def get_meta(self, key: str) -> str:
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
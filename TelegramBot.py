@@ -1,47 +1,223 @@
 from __future__ import annotations
 
 import re
+import sys
 import json
+import time
+import argparse
+import logging
 import html
-import urllib
 import schedule
 import requests
+import queue
 import datetime
+import threading
+import concurrent.futures
 
-from eShop_Prices import eShop_Prices
+from eShop_Prices import eShop_Prices, build_session
+from PricesCache import PricesCache, parse_sale_end
+from Dispatcher import Dispatcher
+from StateStore import StateStore
+from GameCatalog import GameCatalog
+from SingleFlight import SingleFlight
+from MessageCache import MessageCache
+from Metrics import Metrics
+from Outbox import Outbox
+from ExchangeRates import ExchangeRates
+from WebhookServer import WebhookServer
+from PriceHistory import PriceHistory, price_table_hash
+from Price import Price, parse_amount, format_amount
+
+logger = logging.getLogger(__name__)
+
+# Commands get their own latency histogram, anything else is counted as 'other'
+COMMANDS = ('/start', '/help', '/search', '/prices', '/history', '/currency', '/topdiscounts', '/addfavorite', '/threshold', '/myfavorites', '/removefavorite')
+
+def command_name(text: str) -> str:
+    m = re.match('/\\w+', text or '')
+    return m.group(0) if m is not None and m.group(0) in COMMANDS else 'other'
+
+def favorite_key(favorite) -> str:
+    # The string a favorite (game id, or title for old ones) is stored under in subscriptions, thresholds and promo keys
+    return json.dumps(favorite)
+
+def build_promo_key(favorite: str, sale_end: datetime.datetime) -> str:
+    # One promo per favorite and sale window
+    return f'{favorite}|{sale_end.date().isoformat() if sale_end is not None else None}'
+
+def promo_sale_end(promo_key: str) -> datetime.datetime:
+    sale_end = promo_key.rsplit('|', 1)[-1]
+    try:
+        return datetime.datetime.fromisoformat(sale_end)
+    except ValueError:
+        # Keys from before prices were parsed hold the 'On sale until ...' text
+        return parse_sale_end(sale_end)
+
+def get_updates(session: requests.Session, base_url: str, timeout: int = 100, last_processed_update_id: int = None, request_timeout: float = 15) -> [dict]:
+    request_url = f'{base_url}/getUpdates?timeout={timeout}'
+    if last_processed_update_id is not None:
+        request_url += f'&offset={last_processed_update_id + 1}'
+
+    try:
+        # Long polling, so the read timeout has to outlast the poll itself
+        response = session.get(request_url, timeout=(request_timeout, timeout + request_timeout))
+    except requests.exceptions.RequestException as e:
+        logger.warning('Error getting updates: %s', e)
+        return []
+
+    if response.status_code == 200:
+        response = json.loads(response.text)
+        return response['result']
+    else:
+        logger.warning('Error getting updates: status %d', response.status_code)
+        return []
+
+def set_webhook(session: requests.Session, base_url: str, url: str, secret_token: str = None, max_connections: int = 40, timeout: float = 15):
+    params = {'url': url, 'max_connections': max_connections, 'allowed_updates': ['message', 'callback_query']}
+    if secret_token is not None:
+        params['secret_token'] = secret_token
+
+    try:
+        response = session.post(f'{base_url}/setWebhook', json=params, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logger.error('Error setting webhook: %s', e)
+        return
+
+    if response.status_code != 200:
+        logger.error('Error setting webhook: %s', response.text)
+
+def update_chat_id(update: dict) -> int:
+    # None for updates that are neither a message nor a callback query
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    return None
+
+def load_favorite(key: str):
+    return json.loads(key)
 
 class InteractionManager:
+    # One of these is kept per active chat, so it only holds ids: scrapers are shared per currency
+    # and favorites are GameCatalog game ids (or titles, for favorites that aren't in the catalog yet)
+    __slots__ = ('chat_id', 'bot', 'currency', 'favorites', 'thresholds')
+
+    # Part of every rendered message's key, bumped whenever a template below changes so old renders aren't served
+    MESSAGES_VERSION = 1
+
     def __init__(self, chat_id: int, bot: TelegramBot, currency: str = ''):
         self.chat_id = chat_id
         self.bot = bot
 
-        self.eShop_scraper = eShop_Prices(currency=currency)
+        self.currency = sys.intern(currency)
 
         self.favorites = []
+        # favorite_key -> only notify when the best price is at most this (in hundredths)
+        self.thresholds = {}
+
+    @property
+    def eShop_scraper(self) -> eShop_Prices:
+        return self.bot.get_scraper(self.currency)
 
     @staticmethod
     def load(bot: TelegramBot, dump) -> InteractionManager:
-        im = InteractionManager(dump['chat_id'], bot)
-        im.eShop_scraper.currency = dump['currency']
-        im.favorites = dump['favorites']
+        im = InteractionManager(dump['chat_id'], bot, dump['currency'])
+        thresholds = dump.get('thresholds', {})
+        for favorite in dump['favorites']:
+            threshold = thresholds.get(favorite_key(favorite))
+            if isinstance(favorite, str):
+                # Favorites used to be stored by title
+                game_id = bot.catalog.find(favorite)
+                favorite = game_id if game_id is not None else favorite
+            else:
+                favorite = bot.catalog.intern(favorite)
+
+            im.favorites.append(favorite)
+            if threshold is not None:
+                im.thresholds[favorite_key(favorite)] = threshold
 
         return im
 
     def json(self):
         internal_state = {
             'chat_id': self.chat_id,
-            'currency': self.eShop_scraper.currency,
-            'favorites': self.favorites
+            'currency': self.currency,
+            'favorites': list(self.favorites),
+            'thresholds': dict(self.thresholds)
         }
         return internal_state
 
-    def _build_prices_message(self, game_title: str, prices: [{str: str}]):
-        message_body = f'<strong><u>Current prices around the world for <em>{game_title}</em>:</u></strong>'
-        for row in prices:
-            message_body += f'\n<strong>{row["country"]} - </strong> <s>{row["price"]["original_price"] if row["price"]["discount"] else ""}</s> {row["price"]["current_price"]}'
-        
+    def subscriptions(self) -> [(str, str, int)]:
+        # (currency, favorite_key, threshold) rows for the store's subscriptions table
+        return [(self.currency, favorite_key(favorite), self.thresholds.get(favorite_key(favorite))) for favorite in self.favorites]
+
+    def _send_no_match(self, query: str):
+        message_body = f'No game matches the search query <em>{html.escape(query)}</em>.'
+
+        suggestions = self.bot.catalog.suggest(query)
+        if len(suggestions) > 0:
+            message_body += '\nDid you mean:'
+            for suggestion in suggestions:
+                message_body += f'\n<code>{html.escape(suggestion)}</code>'
+
+        self.bot.send_message(
+            self.chat_id,
+            message_body,
+            parse_mode='HTML'
+        )
+
+    def _favorite_title(self, favorite) -> str:
+        if isinstance(favorite, str):
+            return favorite
+
+        # Only missing if the game was never saved, which shouldn't keep the rest of the favorites from being shown
+        game_title = self.bot.catalog.title(favorite)
+        return game_title if game_title is not None else f'Game #{favorite}'
+
+
+    def _prices_message(self, game_title: str, prices: [Price]) -> str:
+        return self.bot.messages.get(f'prices|{self.MESSAGES_VERSION}|{self.currency}|{game_title}', prices, self._build_prices_message, game_title, prices)
+
+    def _build_prices_message(self, game_title: str, prices: [Price]) -> str:
+        with self.bot.metrics.timer('render_seconds', template='prices'):
+            lines = [f'<strong><u>Current prices around the world for <em>{game_title}</em>:</u></strong>']
+            for price in prices:
+                original_price = format_amount(price.original_amount, price.currency) if price.on_sale else ''
+                lines.append(f'<strong>{price.country} - </strong> <s>{original_price}</s> {format_amount(price.amount, price.currency)}')
+
+            return '\n'.join(lines)
+
+    def _build_history_message(self, game_title: str, game_id: int) -> str:
+        # Answered from the recorded history alone, nothing is scraped
+        # History is recorded from the canonical pages, in each country's own currency
+        summary = self.bot.history.summary(game_id, eShop_Prices.CANONICAL) if game_id is not None else []
+        if len(summary) == 0:
+            return f'No prices have been recorded for <em>{html.escape(game_title)}</em> yet, use <code>/prices {html.escape(game_title)}</code> to start tracking it.'
+
+        tracked_since = datetime.date.fromtimestamp(min(entry['tracked_since'] for entry in summary))
+        message_body = f'<strong><u>Lowest prices seen for <em>{html.escape(game_title)}</em> since {tracked_since.isoformat()}:</u></strong>'
+
+        # Cheapest countries (right now) first once converted, the ones there is no rate for last in country order
+        converted = [(self._convert_history_amount(entry['current_price'], entry['currency']), entry) for entry in summary]
+        converted.sort(key=lambda pair: (pair[0] is None, pair[0] or 0))
+
+        for _, entry in converted:
+            lowest_seen = datetime.date.fromtimestamp(entry['lowest_seen'])
+            lowest_price = self._history_price(entry['lowest_price'], entry['currency'], entry['lowest_price_text'])
+            current_price = self._history_price(entry['current_price'], entry['currency'], entry['current_price_text'])
+            message_body += f'\n<strong>{entry["country"]} - </strong> {lowest_price} on {lowest_seen.isoformat()} (now {current_price})'
+
         return message_body
 
+    def _convert_history_amount(self, amount: int, currency: str) -> int:
+        # None when the chat uses the canonical currency or there is no rate for it
+        return self.bot.rates.convert_amount(amount, currency, self.currency) if self.currency != eShop_Prices.CANONICAL else None
+
+    def _history_price(self, amount: int, currency: str, price_text: str) -> str:
+        # Converted to the chat's currency like /prices, as recorded when there is no rate for it
+        converted = self._convert_history_amount(amount, currency)
+        return format_amount(converted, self.currency.upper()) if converted is not None else price_text
+
     def handle_message(self, message):
         text = message['text']
 
@@ -57,6 +233,8 @@ class InteractionManager:
                 \nUse /addfavorite to add a game to your list of favorites. When you use /price without a game name it will give you an option to choose from this list.
                 \nUse /removefavorite to unfavorite a game. The list of your favorite games will be provided for you to choose from.
                 \nUse /myfavorites to see what games you have currently favorited.
+                \nUse /threshold followed by a price and the name of a game (ex.: <code>/threshold 99.90 The Legend of Zelda</code>) to only be told about its sales at that price or less. A price of 0 goes back to every sale.
+                \nUse /history followed by the name of a game (ex.: <code>/history The Legend of Zelda</code>) to see the lowest prices it has had since the bot started tracking it.
 
                 \nAll prices are scraped from the <a href='https://eshop-prices.com'>eShop-Prices</a> website. Consider visiting it to support the creator, as well as for more info and some cool features.
                 ''',
@@ -82,11 +260,21 @@ class InteractionManager:
                 else:
                     self.bot.send_message(self.chat_id, 'You must give a game name to search \\(ex\\.: `/prices The Legend of Zelda`\\)')
         
+        elif re.match('/history', text):
+            m = re.search('(?<=/history ).*', text)
+            if m is not None:
+                self.bot.send_action(self.chat_id, action='typing')
+                self.get_history_from_query(m.group(0))
+            else:
+                self.bot.send_message(self.chat_id, 'You must give a game name to see its price history \\(ex\\.: `/history The Legend of Zelda`\\)')
+        
         elif re.match('/currency', text):
             m = re.search('(?<=/currency ).*', text)
             if m is not None:
-                self.eShop_scraper.currency = m.group(0)
+                self.currency = sys.intern(m.group(0))
                 self.bot.send_message(self.chat_id, f'Currency set to {m.group(0)}')
+                if self.currency != eShop_Prices.CANONICAL and self.currency not in self.bot.rates:
+                    self.bot.learn_exchange_rates_in_background(self.currency)
             else:
                 self.bot.send_action(self.chat_id, 'typing')
                 self.get_available_currencies()
@@ -103,11 +291,25 @@ class InteractionManager:
             else:
                 self.bot.send_message(self.chat_id, 'You must give a game name to add as favorite \\(ex\\.: `/addfavorite The Legend of Zelda`\\)')
         
+        elif re.match('/threshold', text):
+            m = re.match('/threshold (\\S+) (.+)', text)
+            price = parse_amount(m.group(1), self.currency.upper()) if m is not None else None
+            if price is not None and price > 0 and self.currency == eShop_Prices.CANONICAL:
+                self._send_currency_needed()
+            elif price is not None:
+                self.bot.send_action(self.chat_id, action='typing')
+                self.set_threshold_from_query(m.group(2), price)
+            else:
+                self.bot.send_message(self.chat_id, 'You must give a price and a game name \\(ex\\.: `/threshold 99.90 The Legend of Zelda`\\)')
+
         elif re.match('/myfavorites', text):
             self.bot.send_action(self.chat_id, action='typing')
             message_body = '<strong><u>You have favorited the following games:</u></strong>\n'
-            for game_title in self.favorites:
-                message_body += f'\n{game_title}'
+            for favorite in self.favorites:
+                message_body += f'\n{self._favorite_title(favorite)}'
+                threshold = self.thresholds.get(favorite_key(favorite))
+                if threshold is not None:
+                    message_body += f' (sales at {format_amount(threshold, self.currency.upper())} or less)'
             self.bot.send_message(
                 self.chat_id,
                 message_body,
@@ -122,39 +324,38 @@ class InteractionManager:
         data = callback['data']
 
         if re.search('/prices', data):
-            chosen_option = int(re.search('(?<=/prices ).*', data).group(0))
-            game_title = re.sub(
-                ' \(.*\)',
-                '',
-                original_message['reply_markup']['inline_keyboard'][chosen_option][0]['text']
-            )
-            search_results = self.eShop_scraper.search(game_title)
-            print(search_results)
-            game_title = list(search_results.keys())[0]
-            # try:
-            #     prices = self.bot.prices_cache[game_title]['prices']
-            # except KeyError:
-            prices = self.eShop_scraper.get_prices_from_url(search_results[game_title]['uri'])
-                # self.bot.prices_cache[game_title] = {
-                #     'prices': prices,
-                #     'date_added': datetime.datetime.now()
-                # }
+            game_id, game_title = self._chosen_game('/prices', data, original_message)
+            if game_id is not None:
+                prices = self.eShop_scraper.get_prices_from_url(self.bot.catalog.uri(game_id))
+            else:
+                search_results = self.eShop_scraper.search(game_title)
+                game_title = list(search_results.keys())[0]
+                prices = self.eShop_scraper.get_prices_from_url(search_results[game_title]['uri'])
 
             self.bot.update_message(
                 self.chat_id,
                 original_message['message_id'],
-                self._build_prices_message(game_title, prices),
+                self._prices_message(game_title, prices),
                 parse_mode='HTML'
             )
         
-        elif re.match('/addfavorite', data):
-            chosen_option = int(re.search('(?<=/addfavorite ).*', data).group(0))
-            game_title = re.sub(
-                ' \(.*\)',
-                '',
-                original_message['reply_markup']['inline_keyboard'][chosen_option][0]['text']
+        elif re.match('/history', data):
+            game_id, game_title = self._chosen_game('/history', data, original_message)
+            if game_id is None:
+                search_results = self.eShop_scraper.search(game_title)
+                game_title = list(search_results.keys())[0]
+                game_id = self.bot.catalog.game_id(search_results[game_title]['uri'])
+
+            self.bot.update_message(
+                self.chat_id,
+                original_message['message_id'],
+                self._build_history_message(game_title, game_id),
+                parse_mode='HTML'
             )
-            self.favorites.append(game_title)
+
+        elif re.match('/addfavorite', data):
+            game_id, game_title = self._chosen_game('/addfavorite', data, original_message)
+            self.favorites.append(game_id if game_id is not None else game_title)
 
             self.bot.update_message(
                 self.chat_id,
@@ -163,14 +364,29 @@ class InteractionManager:
                 parse_mode='HTML'
             )
 
-        elif re.match('/removefavorite', data):
-            chosen_option = int(re.search('(?<=/removefavorite ).*', data).group(0))
-            game_title = re.sub(
-                ' \(.*\)',
-                '',
-                original_message['reply_markup']['inline_keyboard'][chosen_option][0]['text']
+        elif re.match('/threshold', data):
+            command = re.match('/threshold \\d+', data).group(0)
+            price = int(command.split(' ')[1])
+            if price > 0 and self.currency == eShop_Prices.CANONICAL:
+                self._send_currency_needed()
+                return
+            game_id, game_title = self._chosen_game(command, data, original_message)
+            self.set_threshold(game_id if game_id is not None else game_title, price)
+
+            self.bot.update_message(
+                self.chat_id,
+                original_message['message_id'],
+                self._threshold_message(game_title, price),
+                parse_mode='HTML'
             )
-            self.favorites.remove(game_title)
+
+        elif re.match('/removefavorite', data):
+            game_id, game_title = self._chosen_game('/removefavorite', data, original_message)
+            for favorite in self.favorites:
+                if favorite == game_id or self._favorite_title(favorite) == game_title:
+                    self.favorites.remove(favorite)
+                    self.thresholds.pop(favorite_key(favorite), None)
+                    break
 
             self.bot.update_message(
                 self.chat_id,
@@ -179,6 +395,29 @@ class InteractionManager:
                 parse_mode='HTML'
             )
 
+    def _chosen_game(self, command: str, data: str, original_message: dict) -> (int, str):
+        # Buttons carry the game id ('/prices id:5334'), older buttons still in chats carry the index of the button instead
+        argument = re.search(f'(?<={command} ).*', data).group(0)
+        m = re.match('id:(\\d+)$', argument)
+        if m is not None and int(m.group(1)) in self.bot.catalog:
+            game_id = self.bot.catalog.intern(int(m.group(1)))
+            return game_id, self.bot.catalog.title(game_id)
+
+        for row in original_message['reply_markup']['inline_keyboard']:
+            if row[0]['callback_data'] == data:
+                button_text = row[0]['text']
+                break
+        else:
+            button_text = original_message['reply_markup']['inline_keyboard'][int(argument)][0]['text']
+
+        game_title = re.sub(' \(.*\)', '', button_text)
+        return self.bot.catalog.find(game_title), game_title
+
+    def _callback_data(self, command: str, i: int, game) -> str:
+        # game is a game id, or a uri/legacy favorite title the id is recovered from when possible
+        game_id = game if isinstance(game, int) else self.bot.catalog.game_id(game)
+        return f'{command} id:{game_id}' if game_id is not None else f'{command} {i}'
+
     def search(self, query: str):
         results = self.eShop_scraper.search(query)
 
@@ -188,59 +427,37 @@ class InteractionManager:
         
         self.bot.send_message(self.chat_id, response_body)
 
-    def check_promos(self):
-        print('Checking for promos :)')
-        for favorite in self.favorites:
-            search_results = self.eShop_scraper.search(favorite)
-            game_title = list(search_results.keys())[0]
-            try:
-                prices = self.bot.prices_cache[game_title]['prices']
-            except KeyError:
-                prices = self.eShop_scraper.get_prices_from_url(search_results[game_title]['uri'])
-                self.bot.prices_cache[game_title] = {
-                    'prices': prices,
-                    'date_added': datetime.datetime.now()
-                }
+    def notify_promo(self, favorite: str, game_title: str, prices: [Price], promo_key: str):
+        if self.bot.was_informed(promo_key, self.chat_id):
+            logger.debug('Chat %d has already been informed about %s', self.chat_id, promo_key)
+            return
 
-            if prices[0]['price']['discount']:
-                try:
-                    if self.chat_id in self.bot.prices_cache[game_title]['informed_users']:
-                        print('User has already been informed about this promo!')
-                        continue
-                except KeyError: # 'informed_users' doesn't exist
-                    self.bot.prices_cache[game_title]['informed_users'] = []
-
-                self.bot.send_message(
-                    self.chat_id,
-                    f'<strong>{html.escape(favorite)} {prices[0]["meta"]} on eShop {prices[0]["country"]}.</strong>',
-                    parse_mode='HTML'
-                    )
-                self.get_prices_from_query(game_title)
-                
-                self.bot.prices_cache[game_title]['informed_users'].append(self.chat_id)
+        sale_end = f' until {prices[0].sale_end:%b %d, %Y}' if prices[0].sale_end is not None else ''
+        self.bot.send_message(
+            self.chat_id,
+            f'<strong>{html.escape(favorite)} is {prices[0].discount}% off{sale_end} on eShop {prices[0].country}.</strong>',
+            parse_mode='HTML'
+            )
+        self.bot.send_message(
+            self.chat_id,
+            self._prices_message(game_title, prices),
+            parse_mode='HTML'
+        )
+        
+        self.bot.mark_informed(promo_key, self.chat_id)
     
     def get_prices_from_query(self, query: str):
         search_results = self.eShop_scraper.search(query)
 
         if len(search_results.keys()) == 0:
-            self.bot.send_message(
-                self.chat_id,
-                f'No game matches the search query _{query}_\\.'
-            )
+            self._send_no_match(query)
         elif len(search_results.keys()) == 1:
             game_title = list(search_results.keys())[0]
-            # try:
-            #     prices = self.bot.prices_cache[game_title]['prices']
-            # except KeyError:
             prices = self.eShop_scraper.get_prices_from_url(search_results[game_title]['uri'])
-                # self.bot.prices_cache[game_title] = {
-                #     'prices': prices,
-                #     'date_added': datetime.datetime.now()
-                # }
             
             self.bot.send_message(
                 self.chat_id,
-                self._build_prices_message(game_title, prices),
+                self._prices_message(game_title, prices),
                 parse_mode='HTML'
             )
         elif len(search_results.keys()) > 1:
@@ -248,7 +465,7 @@ class InteractionManager:
             for i, result in enumerate(search_results):
                 inline_buttons.append([{
                     'text': f'{result} ({search_results[result]["best_price"]})',
-                    'callback_data': f'/prices {i}'
+                    'callback_data': self._callback_data('/prices', i, search_results[result]['uri'])
                 }])
 
             reply_markup = {
@@ -261,6 +478,81 @@ class InteractionManager:
                 reply_markup=reply_markup
             )
 
+    def get_history_from_query(self, query: str):
+        search_results = self.eShop_scraper.search(query)
+
+        if len(search_results.keys()) == 0:
+            self._send_no_match(query)
+        elif len(search_results.keys()) == 1:
+            game_title = list(search_results.keys())[0]
+
+            self.bot.send_message(
+                self.chat_id,
+                self._build_history_message(game_title, self.bot.catalog.game_id(search_results[game_title]['uri'])),
+                parse_mode='HTML'
+            )
+        elif len(search_results.keys()) > 1:
+            inline_buttons = []
+            for i, result in enumerate(search_results):
+                inline_buttons.append([{
+                    'text': result,
+                    'callback_data': self._callback_data('/history', i, search_results[result]['uri'])
+                }])
+
+            self.bot.send_message(
+                self.chat_id,
+                f'More than one game matches _{query}_, which of the following would you like the price history for?',
+                reply_markup={'inline_keyboard': inline_buttons}
+            )
+
+    def set_threshold_from_query(self, query: str, price: int):
+        search_results = self.eShop_scraper.search(query)
+
+        if len(search_results.keys()) == 0:
+            self._send_no_match(query)
+        elif len(search_results.keys()) == 1:
+            game_title = list(search_results.keys())[0]
+            game_id = self.bot.catalog.game_id(search_results[game_title]['uri'])
+            self.set_threshold(game_id if game_id is not None else game_title, price)
+
+            self.bot.send_message(
+                self.chat_id,
+                self._threshold_message(game_title, price),
+                parse_mode='HTML'
+            )
+        elif len(search_results.keys()) > 1:
+            inline_buttons = []
+            for i, result in enumerate(search_results):
+                inline_buttons.append([{
+                    'text': f'{result} ({search_results[result]["best_price"]})',
+                    'callback_data': self._callback_data(f'/threshold {price}', i, search_results[result]['uri'])
+                }])
+
+            self.bot.send_message(
+                self.chat_id,
+                f'More than one game matches _{query}_, which of the following is the alert for?\n_\\(Best available price in parenthesis\\)_',
+                reply_markup={'inline_keyboard': inline_buttons}
+            )
+
+    def set_threshold(self, favorite, price: int):
+        # A threshold favorites the game if it wasn't yet, 0 goes back to being told about every sale
+        if favorite not in self.favorites:
+            self.favorites.append(favorite)
+
+        if price > 0:
+            self.thresholds[favorite_key(favorite)] = price
+        else:
+            self.thresholds.pop(favorite_key(favorite), None)
+
+    def _send_currency_needed(self):
+        # Thresholds are amounts in the chat's currency, without one there is nothing to hold prices against
+        self.bot.send_message(self.chat_id, 'Choose a currency with /currency before giving a price \(ex\.: `/currency EUR`\)')
+
+    def _threshold_message(self, game_title: str, price: int) -> str:
+        if price > 0:
+            return f'You will be told when <em>{html.escape(game_title)}</em> is on sale for {format_amount(price, self.currency.upper())} or less.'
+        return f'You will be told about every sale of <em>{html.escape(game_title)}</em>.'
+
     def get_prices_empty(self):
         message_body = '<strong><u>Do you want to see the prices for one of your favorited games?</u></strong>'
         message_body += '\nTo get prices for a specific game use <code>/prices [game_name]</code>'
@@ -268,8 +560,8 @@ class InteractionManager:
         inline_buttons = []
         for i, favorited_game in enumerate(self.favorites):
             inline_buttons.append([{
-                'text': favorited_game,
-                'callback_data': f'/prices {i}'
+                'text': self._favorite_title(favorited_game),
+                'callback_data': self._callback_data('/prices', i, favorited_game)
             }])
         
         reply_markup = {
@@ -285,18 +577,22 @@ class InteractionManager:
     
     def get_top_discounts(self):
         top_discounts = self.eShop_scraper.get_top_discounts()
-        
-        message_body = f'<strong><u>These are the 20 games with the greatest discount (ordered by discount %)</u></strong>'
-        for entry in top_discounts:
-            message_body += f'\n\n<strong>{entry} - </strong> {top_discounts[entry]["best_price"]}'
-        message_body += f'\n\n<a href="https://eshop-prices.com/games/on-sale?sort_by=discount&direction=desc&currency={self.eShop_scraper.currency}">See the all discounted games</a>'
-        
+
         self.bot.send_message(
             self.chat_id,
-            message_body,
+            self.bot.messages.get(f'top_discounts|{self.MESSAGES_VERSION}|{self.currency}', top_discounts, self._build_top_discounts_message, top_discounts),
             parse_mode='HTML'
         )
 
+    def _build_top_discounts_message(self, top_discounts: {str: dict}) -> str:
+        with self.bot.metrics.timer('render_seconds', template='top_discounts'):
+            lines = ['<strong><u>These are the 20 games with the greatest discount (ordered by discount %)</u></strong>']
+            for entry in top_discounts:
+                lines.append(f'<strong>{entry} - </strong> {top_discounts[entry]["best_price"]}')
+            lines.append(f'<a href="https://eshop-prices.com/games/on-sale?sort_by=discount&direction=desc&currency={self.currency}">See the all discounted games</a>')
+
+            return '\n\n'.join(lines)
+
     def get_available_currencies(self):
         available_currencies = self.eShop_scraper.get_available_currencies()
 
@@ -316,13 +612,11 @@ class InteractionManager:
         search_results = self.eShop_scraper.search(query)
 
         if len(search_results.keys()) == 0:
-            self.bot.send_message(
-                self.chat_id,
-                f'No game matches the search query _{query}_\\.'
-            )
+            self._send_no_match(query)
         elif len(search_results.keys()) == 1:
             game_title = list(search_results.keys())[0]
-            self.favorites.append(game_title)
+            game_id = self.bot.catalog.game_id(search_results[game_title]['uri'])
+            self.favorites.append(game_id if game_id is not None else game_title)
             
             self.bot.send_message(
                 self.chat_id,
@@ -334,7 +628,7 @@ class InteractionManager:
             for i, result in enumerate(search_results):
                 inline_buttons.append([{
                     'text': f'{result} ({search_results[result]["best_price"]})',
-                    'callback_data': f'/addfavorite {i}'
+                    'callback_data': self._callback_data('/addfavorite', i, search_results[result]['uri'])
                 }])
 
             reply_markup = {
@@ -344,7 +638,7 @@ class InteractionManager:
             self.bot.send_message(
                 self.chat_id,
                 f'More than one game matches _{query}_, which of the following would you like the prices for?\n_\\(Best available price in parenthesis\\)_',
-                reply_markup=urllib.parse.quote(json.dumps(reply_markup), safe='')
+                reply_markup=reply_markup
             )
     
     def remove_favorite(self):
@@ -353,8 +647,8 @@ class InteractionManager:
         inline_buttons = []
         for i, favorited_game in enumerate(self.favorites):
             inline_buttons.append([{
-                'text': favorited_game,
-                'callback_data': f'/removefavorite {i}'
+                'text': self._favorite_title(favorited_game),
+                'callback_data': self._callback_data('/removefavorite', i, favorited_game)
             }])
         
         reply_markup = {
@@ -369,8 +663,177 @@ class InteractionManager:
         )
 
 class TelegramBot:
-    def __init__(self, token: str):
-        self.base_url = f'https://api.telegram.org/bot{token}'
+    def __init__(self, token: str, pool_size: int = 10, timeout: float = 15, workers: int = 0, max_in_flight: int = 100, promo_concurrency: int = 4,
+                 api_url: str = 'https://api.telegram.org', eshop_url: str = 'https://eshop-prices.com/', state_path: str = 'state.db', idle_timeout: int = 30 * 60,
+                 send_workers: int = 4, send_rate: float = 30, chat_send_rate: float = 1, dump_interval: float = 5, metrics: Metrics = None,
+                 prewarm_interval: int = 5 * 60, prewarm_games: int = 50, rates_interval: int = 6 * 60 * 60,
+                 rates_game: str = 'games/5334-super-mario-3d-world-bowser-s-fury', shard: int = 0, shards: int = 1, sync_interval: int = 10 * 60,
+                 shared_send_at=None):
+        self.base_url = f'{api_url}/bot{token}'
+        self.eshop_url = eshop_url
+        self.running = False
+        self.stopped = threading.Event()
+
+        # Scheduled jobs run on their own thread, independently of how updates come in
+        self.scheduler = schedule.Scheduler()
+        self.scheduler_thread = None
+
+        # Webhook mode: updates arrive on the server's threads, and state is dumped every dump_interval seconds
+        self.webhook = None
+        self.dump_interval = dump_interval
+        self.inline_lock = threading.Lock()
+        self.promo_concurrency = promo_concurrency
+
+        # Every prewarm_interval seconds the top discounts of every active currency and the prices of the prewarm_games
+        # most favorited games are scraped again if they would expire before the next run, so they are always cached
+        self.prewarm_interval = prewarm_interval
+        self.prewarm_games = prewarm_games
+
+        # Prices are scraped once, canonically, and converted to each currency with rates learned every rates_interval
+        # seconds from rates_game's prices page (a game sold in every country)
+        self.rates_interval = rates_interval
+        self.rates_game = rates_game
+
+        # Sharded mode (see ShardedBot): this process only handles the chats with chat_id % shards == shard, state and
+        # cache are shared with the other shards through the store. Shard 0 runs the jobs that concern every chat (promos,
+        # catalog, prewarming, exchange rates), the others pick up what it saved every sync_interval seconds.
+        self.shard = shard
+        self.shards = shards
+        self.sync_interval = sync_interval
+
+        # workers=0 handles every update inline, otherwise updates are spread over a worker pool (one chat at a time per chat)
+        self.dispatcher = Dispatcher(workers=workers, max_in_flight=max_in_flight) if workers > 0 else None
+
+        # Latency histograms and counters of the hot paths, see Metrics.serve() for exposing them
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.timeout = timeout
+        self.session = build_session(pool_size=pool_size)
+        self.scraper_session = build_session(pool_size=pool_size)
+
+        # Everything sent to chats is queued and drained as fast as Telegram's rate limits allow
+        self.outbox = Outbox(self.session, self.base_url, timeout=timeout, workers=send_workers, global_rate=send_rate, chat_rate=chat_send_rate,
+                             metrics=self.metrics, shared_send_at=shared_send_at)
+
+        self.state_lock = threading.Lock()
+        self.dirty_chats = set()
+        self.new_informed_users = []
+        self.forgotten_promos = []
+
+        # Chats are loaded from the store on first use and dropped again after idle_timeout seconds without updates
+        self.idle_timeout = idle_timeout
+        self.last_access = {}
+
+        self.scrapers = {}
+        self.scrapers_lock = threading.Lock()
+        self.flights = SingleFlight()
+        self.messages = MessageCache()
+
+        self.store = StateStore(state_path)
+
+        self.catalog = GameCatalog()
+        self.catalog.restore(self.store.load_games())
+        self.catalog.loader = self.store.load_game
+        self.catalog.crawl_page = int(self.store.get_meta('catalog_crawl_page') or 1)
+        self.catalog.complete = self.store.get_meta('catalog_complete') == '1'
+
+        self.history = PriceHistory(self.store)
+
+        exchange_rates = self.store.get_meta('exchange_rates')
+        self.rates = ExchangeRates.load(json.loads(exchange_rates)) if exchange_rates is not None else ExchangeRates()
+        self.learning_currencies = set()
+
+        if self.store.is_empty():
+            self.__import_legacy_state()
+        else:
+            self.prices_cache = PricesCache()
+            self.informed_users = self.store.load_informed_users()  # promo key -> {chat_id}
+            self.ongoing_interactions = {}
+
+            last_processed_update_id = self.store.get_meta('last_processed_update_id')
+            self.last_processed_update_id = int(last_processed_update_id) if last_processed_update_id is not None else None
+
+        self.prices_cache.loader = self.store.load_cache_entry
+
+        self.metrics.collect('prices_cache', self.prices_cache.stats)
+        self.metrics.collect('messages_cache', self.messages.stats)
+        self.metrics.collect('flights', self.flights.stats)
+        self.metrics.collect('outbox', self.outbox.stats)
+
+        # Hash of the last prices table check_promos saw per (currency, favorite_key), subscribers are only
+        # looked at again when it changes
+        self.price_hashes = self.store.load_price_hashes()
+        self.new_price_hashes = []
+        self.promos_checked_at = float(self.store.get_meta('promos_checked_at') or 0)
+
+        self.__migrate_promo_keys()
+        if self.store.get_meta('subscriptions_built') != '1':
+            self.__build_subscriptions()
+        if self.store.get_meta('history_canonical') != '1':
+            self.__migrate_price_history()
+
+    def __migrate_promo_keys(self):
+        # Promos used to be keyed by game title instead of favorite_key, and by the 'On sale until ...' text instead of the date
+        for promo_key in list(self.informed_users):
+            game = promo_key.rsplit('|', 1)[0]
+            try:
+                json.loads(game)
+            except ValueError:
+                game_id = self.catalog.find(game)
+                game = favorite_key(game_id if game_id is not None else game)
+
+            new_promo_key = build_promo_key(game, promo_sale_end(promo_key))
+            if new_promo_key == promo_key:
+                continue
+
+            chat_ids = self.informed_users.pop(promo_key)
+            self.informed_users.setdefault(new_promo_key, set()).update(chat_ids)
+            self.forgotten_promos.append(promo_key)
+            self.new_informed_users.extend((new_promo_key, chat_id) for chat_id in chat_ids)
+
+    def __build_subscriptions(self):
+        # dump_state() keeps the subscriptions table up to date, chats saved before it existed are added once here
+        subscriptions = {}
+        for chat_id, state in self.__iter_chat_states():
+            subscriptions[chat_id] = InteractionManager.load(self, state).subscriptions()
+            if len(subscriptions) >= 1000:
+                self.store.save(subscriptions=subscriptions)
+                subscriptions = {}
+
+        self.store.save(subscriptions=subscriptions, meta={'subscriptions_built': '1'})
+
+    def __migrate_price_history(self):
+        # History used to be recorded under the currency of the chat that scraped the page. The page was fetched without a
+        # currency all along, so those runs are in each country's own currency like the canonical ones.
+        moved = self.store.merge_price_history(eShop_Prices.CANONICAL)
+        self.store.save(meta={'history_canonical': '1'})
+        logger.info('Moved %d price history runs to the canonical currency', moved)
+
+    def __import_legacy_state(self):
+        # State from before the SQLite store lived in one JSON file per attribute, rewritten in full on every dump
+        self.prices_cache = PricesCache()
+        self.informed_users = {}
+        try:
+            with open('prices_cache') as cache_file:
+                cache_json = json.load(cache_file)
+
+            if 'entries' in cache_json:
+                self.prices_cache = PricesCache.load(cache_json)
+            else:
+                # Old format ({game_title: {'prices', 'date_added', 'informed_users'}}), keep only who was informed
+                for cached_game in cache_json:
+                    cached_prices = cache_json[cached_game]['prices']
+                    if 'informed_users' in cache_json[cached_game] and len(cached_prices) > 0:
+                        self.informed_users[f'{cached_game}|{cached_prices[0]["meta"]}'] = cache_json[cached_game]['informed_users']
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open('informed_users') as iu_file:
+                self.informed_users = json.load(iu_file)
+        except FileNotFoundError:
+            pass
+        self.informed_users = {promo_key: set(chat_ids) for promo_key, chat_ids in self.informed_users.items()}
 
         self.ongoing_interactions = {}
         try:
@@ -384,140 +847,551 @@ class TelegramBot:
         try:
             with open('last_processed_update_id') as lpui_file:
                 self.last_processed_update_id = int(lpui_file.read())
-        except FileNotFoundError:
+        except (FileNotFoundError, ValueError):
             self.last_processed_update_id = None
 
-        try:
-            with open('prices_cache') as cache_file:
-                self.prices_cache = json.load(cache_file)
-            
-            for cached_game in self.prices_cache:
-                self.prices_cache[cached_game]['date_added'] = datetime.datetime.strptime(self.prices_cache[cached_game]['date_added'], '%Y-%m-%d %H:%M:%S.%f')
-        except FileNotFoundError:
-            self.prices_cache = {}
+        # Everything loaded counts as changed, so the first dump_state() moves it all into the store
+        self.dirty_chats.update(self.ongoing_interactions)
+        self.prices_cache.changed_keys.update(self.prices_cache.entries)
+        for promo_key, chat_ids in self.informed_users.items():
+            self.new_informed_users.extend((promo_key, chat_id) for chat_id in chat_ids)
 
     def __get_updates(self, timeout:int=100, last_processed_update_id:int=None):
-        request_url = f'{self.base_url}/getUpdates?timeout={timeout}'
-        if last_processed_update_id is not None:
-            request_url += f'&offset={last_processed_update_id + 1}'
-
-        response = requests.get(request_url)
-        
-        if response.status_code == 200:
-            response = json.loads(response.text)
-            return response['result']
-        else:
-            print("Error")
+        return get_updates(self.session, self.base_url, timeout=timeout, last_processed_update_id=last_processed_update_id, request_timeout=self.timeout)
 
     def send_message(self, chat_id: int, message_body: str, parse_mode: str='MarkdownV2', reply_markup=None):
-        escaped_message_body = urllib.parse.quote(message_body)
-        request_url = f'{self.base_url}/sendMessage?chat_id={chat_id}&text={escaped_message_body}&parse_mode={parse_mode}'
+        params = {'chat_id': chat_id, 'text': message_body, 'parse_mode': parse_mode}
         if reply_markup is not None:
-            request_url += f'&reply_markup={urllib.parse.quote(json.dumps(reply_markup), safe="")}'
-        response = requests.get(request_url)
-
-        if response.status_code != 200:
-            print('Error sending message')
-            print(json.loads(response.text)['description'])
+            params['reply_markup'] = reply_markup
+        self.outbox.enqueue(chat_id, 'sendMessage', params)
 
     def update_message(self, chat_id: int, message_id: int, message_body: str, parse_mode: str='MarkdownV2', reply_markup=None):
-        escaped_message_body = urllib.parse.quote(message_body)
-        request_url = f'{self.base_url}/editMessageText?chat_id={chat_id}&message_id={message_id}&text={escaped_message_body}&parse_mode={parse_mode}'
+        params = {'chat_id': chat_id, 'message_id': message_id, 'text': message_body, 'parse_mode': parse_mode}
         if reply_markup is not None:
-            request_url += f'&reply_markup={urllib.parse.quote(json.dumps(reply_markup), safe="")}'
-        response = requests.get(request_url)
-
-        if response.status_code != 200:
-            print('Error updating message')
+            params['reply_markup'] = reply_markup
+        self.outbox.enqueue(chat_id, 'editMessageText', params)
 
     def send_action(self, chat_id: int, action: str):
-        request_url = f'{self.base_url}/sendChatAction?chat_id={chat_id}&action={action}'
-        response = requests.get(request_url)
-
-        if response.status_code != 200:
-            print('Error sending chat action')
+        self.outbox.enqueue(chat_id, 'sendChatAction', {'chat_id': chat_id, 'action': action})
 
     def check_promos(self):
-        for chat_id in self.ongoing_interactions:
-            self.ongoing_interactions[chat_id].check_promos()
+        logger.info('Checking for promos')
+
+        # Favorites changed in memory are written first, the subscriptions table is what gets checked
+        self.dump_state()
+        checked_at = time.time()
+
+        evaluated = 0
+        for currency, favorites in self.store.load_subscribed_favorites().items():
+            scraper = self.get_scraper(currency)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.promo_concurrency) as executor:
+                promos = executor.map(lambda favorite: self.__fetch_favorite(scraper, load_favorite(favorite)), favorites)
+
+                for favorite, (game_title, prices) in zip(favorites, promos):
+                    if prices is None:
+                        # Every subscriber gets looked at again next time, including those added since this check
+                        self.__forget_price_hash(currency, favorite)
+                        continue
+
+                    # With the same prices as last time only subscriptions added (or changed) since then are looked at
+                    price_hash = price_table_hash(prices)
+                    changed = self.price_hashes.get((currency, favorite)) != price_hash
+                    if changed:
+                        with self.state_lock:
+                            self.price_hashes[(currency, favorite)] = price_hash
+                            self.new_price_hashes.append((currency, favorite, price_hash))
+
+                    if not prices[0].on_sale:
+                        continue
+
+                    promo_key = build_promo_key(favorite, prices[0].sale_end)
+                    favorite_title = load_favorite(favorite) if favorite.startswith('"') else game_title
+
+                    # Thresholds are in the chats' currency, prices without a rate to it stay in their country's and
+                    # can't be held against them until one is learned
+                    amounts = [price.amount for price in prices if price.currency == currency.upper() and price.amount is not None]
+                    best_price = min(amounts) if len(amounts) > 0 else None
+                    unchecked = False
+
+                    for chat_id, threshold in self.store.load_subscribers(currency, favorite, None if changed else self.promos_checked_at):
+                        evaluated += 1
+                        if self.was_informed(promo_key, chat_id):
+                            continue
+                        if threshold is not None and best_price is None:
+                            # Chats without a currency get no more thresholds, old ones are held once it is chosen
+                            unchecked = unchecked or currency != eShop_Prices.CANONICAL
+                            continue
+                        if threshold is not None and best_price > threshold:
+                            continue
+
+                        self.__dispatch(chat_id, 'promo', self.get_interaction(chat_id).notify_promo, favorite_title, game_title, prices, promo_key)
+
+                    if unchecked:
+                        self.__forget_price_hash(currency, favorite)
+
+        self.promos_checked_at = checked_at
+        logger.info('Checked promos, %d subscriptions evaluated', evaluated)
+
+    def __forget_price_hash(self, currency: str, favorite: str):
+        # No prices table hashes to '', so the favorite counts as changed on the next check
+        with self.state_lock:
+            self.price_hashes[(currency, favorite)] = ''
+            self.new_price_hashes.append((currency, favorite, ''))
+
+    def __fetch_favorite(self, scraper: eShop_Prices, favorite) -> (str, [Price]):
+        # A favorite that can't be fetched is skipped this time, the rest of the check goes on
+        try:
+            return self.__fetch_favorite_prices(scraper, favorite)
+        except requests.exceptions.RequestException as e:
+            logger.warning('Could not fetch %s: %s', favorite, e)
+            game_title = self.catalog.title(favorite) if isinstance(favorite, int) else None
+            return game_title if game_title is not None else str(favorite), None
+
+    def __fetch_favorite_prices(self, scraper: eShop_Prices, favorite) -> (str, [Price]):
+        if isinstance(favorite, str):
+            search_results = scraper.search(favorite)
+            if isinstance(search_results, str) or len(search_results) == 0:
+                logger.warning('Could not find %s: %s', favorite, search_results)
+                return favorite, None
+
+            game_title = list(search_results.keys())[0]
+            game_uri = search_results[game_title]['uri']
+        else:
+            # Known games skip the search and go straight to their prices page
+            game = self.catalog.get(favorite)
+            if game is None:
+                logger.warning('Game %d is not in the catalog', favorite)
+                return str(favorite), None
+            game_title = game.title
+            game_uri = game.uri
+
+        prices = scraper.get_prices_from_url(game_uri)
+        if isinstance(prices, str) or len(prices) == 0:
+            logger.warning('Could not get prices for %s: %s', game_title, prices)
+            return game_title, None
+
+        return game_title, prices
+
+    def __iter_chat_states(self) -> [(int, dict)]:
+        # Chats in memory may have changes that aren't in the store yet, the rest are read straight from the store
+        with self.state_lock:
+            loaded_chats = list(self.ongoing_interactions.items())
+        for chat_id, interaction in loaded_chats:
+            yield chat_id, interaction.json()
+
+        loaded_chats = {chat_id for chat_id, _ in loaded_chats}
+        for chat_id, state in self.store.iter_chats():
+            if chat_id not in loaded_chats:
+                yield chat_id, state
 
     def cache_maintenance(self):
+        removed = self.prices_cache.purge_expired()
+        logger.info('Removed %d expired cache entries %s', removed, self.prices_cache.stats())
+        logger.info('Removed %d expired cache entries from the store', self.store.purge_cache())
+        logger.info('Compacted away %d price history runs', self.history.compact())
+
+        # Promos are keyed by the day their sale ends, so finished sales can be forgotten
+        with self.state_lock:
+            promo_keys = list(self.informed_users)
+
         to_remove = []
-        
-        for cached_game in self.prices_cache:
-            cached_prices = self.prices_cache[cached_game]['prices']
-            if cached_prices[0]['price']['discount']:
-                sale_end_date = datetime.datetime.strptime(cached_prices[0]['meta'].replace('On sale until ', ''), '%b. %d, %Y')
-                if sale_end_date < datetime.datetime.now():
-                    print('Cached sale is over!')
-            else:
-                # Cached game isn't on sale
-                time_since_cached = datetime.datetime.now() - self.prices_cache[cached_game]['date_added']
-                if time_since_cached.hours > 12:
-                    to_remove.append(cached_game)
-                    print(cached_game, 'cached for more than 10 seconds, marked to remove')
-        
-        for cached_game in to_remove:
-            del self.prices_cache[cached_game]
+        for promo_key in promo_keys:
+            sale_end_date = promo_sale_end(promo_key)
+            if sale_end_date is not None and sale_end_date + datetime.timedelta(days=1) < datetime.datetime.now():
+                to_remove.append(promo_key)
 
-    def run(self):
-        schedule.every(12).hours.do(self.check_promos)
-        schedule.every(12).hours.do(self.cache_maintenance)
+        with self.state_lock:
+            for promo_key in to_remove:
+                del self.informed_users[promo_key]
+            self.forgotten_promos.extend(to_remove)
+
+    def prewarm_cache(self):
+        # Refreshed ahead of expiry, with a margin of a whole interval in case a run is late. Unchanged pages only cost a 304.
+        # Pages are cached canonically, so each one is refreshed once whatever currencies it is shown in.
+        refresh_before = time.time() + 2 * self.prewarm_interval
+        scraper = self.get_scraper(eShop_Prices.CANONICAL)
+
+        refreshes = []
+        if self.__expires_before(PricesCache.top_discounts_key(eShop_Prices.CANONICAL), refresh_before):
+            refreshes.append(('top_discounts', scraper.get_top_discounts, ()))
+
+        game_uris = set()
+        for _, favorite in self.store.load_popular_favorites(self.prewarm_games):
+            # Favorites that aren't in the catalog yet need a search first, check_promos takes care of those
+            game_id = load_favorite(favorite)
+            game_uri = self.catalog.uri(game_id) if not isinstance(game_id, str) and game_id in self.catalog else None
+            if game_uri is not None and game_uri not in game_uris and self.__expires_before(PricesCache.prices_key(game_uri, eShop_Prices.CANONICAL), refresh_before):
+                game_uris.add(game_uri)
+                refreshes.append(('prices', scraper.get_prices_from_url, (game_uri,)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.promo_concurrency) as executor:
+            for page, refresh, args in refreshes:
+                executor.submit(self.__prewarm, page, refresh, *args)
+
+        logger.info('Prewarmed %d cache entries', len(refreshes))
+
+    def __expires_before(self, cache_key: str, refresh_before: float) -> bool:
+        expires_at = self.prices_cache.expires_at(cache_key)
+        return expires_at is None or expires_at < refresh_before
+
+    def __prewarm(self, page: str, refresh, *args):
         try:
-            while True:
-                schedule.run_pending()
-                for update in self.__get_updates(timeout=300, last_processed_update_id=self.last_processed_update_id):
-                    if 'message' in update.keys():
-                        message = update['message']
+            refresh(*args, refresh=True)
+        except Exception:
+            logger.exception('Error prewarming %s %s', page, args)
+            return
+
+        self.metrics.inc('prewarm_refreshes_total', page=page)
+
+    def refresh_exchange_rates(self):
+        # Every currency chats use (or have favorites in), stored or in memory
+        with self.state_lock:
+            currencies = {interaction.currency for interaction in self.ongoing_interactions.values()}
+        currencies.update(self.store.load_currencies())
+
+        self.__learn_exchange_rates(currencies)
+
+    def learn_exchange_rates_in_background(self, currency: str):
+        # A chat just switched to a currency nothing is converted to yet, it shouldn't have to wait for the next refresh
+        with self.state_lock:
+            if currency.upper() in self.learning_currencies:
+                return
+            self.learning_currencies.add(currency.upper())
+
+        threading.Thread(target=self.__learn_exchange_rates, args=({currency},), name='exchange-rates', daemon=True).start()
+
+    def __learn_exchange_rates(self, currencies: {str}):
+        currencies = {currency.upper(): currency for currency in currencies if currency != eShop_Prices.CANONICAL}
+
+        learned = []
+        for upper_currency, currency in currencies.items():
+            try:
+                if self.get_scraper(currency).learn_exchange_rates(self.rates_game) > 0:
+                    learned.append(upper_currency)
+                else:
+                    logger.warning('Could not learn exchange rates to %s', currency)
+            except Exception:
+                logger.exception('Error learning exchange rates to %s', currency)
+            finally:
+                with self.state_lock:
+                    self.learning_currencies.discard(upper_currency)
+
+        # Other shards may have saved rates since this one last synced, only the currencies learned here replace theirs
+        stored = self.store.get_meta('exchange_rates')
+        rates = json.loads(stored)['rates'] if stored is not None else {}
+        current = self.rates.json()['rates']
+        rates.update({currency: current[currency] for currency in learned})
+        self.rates.restore({**current, **rates})
+        self.store.save(meta={'exchange_rates': json.dumps(self.rates.json())})
+
+        logger.info('Learned exchange rates to %d of %d currencies', len(learned), len(currencies))
+
+    def sync_shared_state(self):
+        # Shards other than 0 only learn about crawled games and new exchange rates from the store
+        self.catalog.restore(self.store.load_games())
+        self.catalog.complete = self.store.get_meta('catalog_complete') == '1'
+
+        exchange_rates = self.store.get_meta('exchange_rates')
+        if exchange_rates is not None:
+            self.rates.restore(json.loads(exchange_rates)['rates'])
 
-                        chat_id = message['chat']['id']
+    def refresh_catalog(self, pages: int = 10):
+        crawled = self.catalog.crawl(self.get_scraper(''), pages)
+        logger.info('Crawled %d listing pages, %d games in the catalog (%d local hits, %d misses)', crawled, len(self.catalog), self.catalog.local_hits, self.catalog.local_misses)
 
-                        if chat_id not in self.ongoing_interactions:
-                            self.ongoing_interactions[chat_id] = InteractionManager(chat_id, self)
-                        
-                        self.ongoing_interactions[chat_id].handle_message(message)
+    def was_informed(self, promo_key: str, chat_id: int) -> bool:
+        return chat_id in self.informed_users.get(promo_key, ())
 
-                    elif 'callback_query' in update.keys():
-                        chat_id = update['callback_query']['message']['chat']['id']
+    def mark_informed(self, promo_key: str, chat_id: int):
+        with self.state_lock:
+            self.informed_users.setdefault(promo_key, set()).add(chat_id)
+            self.new_informed_users.append((promo_key, chat_id))
+
+    def __start_scheduler(self):
+        self.scheduler.every(5).minutes.do(self.evict_idle_chats)
+        if self.shard != 0:
+            self.scheduler.every(self.sync_interval).seconds.do(self.sync_shared_state)
+        else:
+            self.scheduler.every(12).hours.do(self.check_promos)
+            self.scheduler.every(12).hours.do(self.cache_maintenance)
+            self.scheduler.every(1).hours.do(self.refresh_catalog)
+            if self.prewarm_interval > 0:
+                self.scheduler.every(self.prewarm_interval).seconds.do(self.prewarm_cache)
+            if self.rates_interval > 0:
+                self.scheduler.every(self.rates_interval).seconds.do(self.refresh_exchange_rates)
+                # Until some rates are learned prices are shown in each country's own currency, so the first ones can't wait
+                if len(self.rates.rates) == 0:
+                    threading.Thread(target=self.refresh_exchange_rates, name='exchange-rates', daemon=True).start()
+
+        self.scheduler_thread = threading.Thread(target=self.__run_scheduler, name='scheduler', daemon=True)
+        self.scheduler_thread.start()
+
+    def __run_scheduler(self):
+        while not self.stopped.is_set():
+            try:
+                self.scheduler.run_pending()
+            except Exception:
+                logger.exception('Error running scheduled job')
 
-                        if chat_id not in self.ongoing_interactions:
-                            self.ongoing_interactions[chat_id] = InteractionManager(chat_id, self)
-                        
-                        self.ongoing_interactions[chat_id].handle_callback(update['callback_query'])
+            self.stopped.wait(1)
 
-                    else:
-                        print('Skipping non user non new message')
+    def run(self):
+        # Long polling getUpdates
+        self.running = True
+        self.__start_scheduler()
+        try:
+            while self.running:
+                for update in self.__get_updates(timeout=300, last_processed_update_id=self.last_processed_update_id):
+                    if not self.process_update(update):
                         continue
 
                     self.last_processed_update_id = update['update_id']
                 
                 self.dump_state()
         except KeyboardInterrupt:
-            self.exit_gracefully()
+            pass
+
+        self.exit_gracefully()
+
+    def run_webhook(self, url: str = None, host: str = '0.0.0.0', port: int = 8443, path: str = '/', secret_token: str = None, max_connections: int = 40):
+        # Telegram POSTs every update to url as soon as it arrives. With url=None the webhook is left as it is,
+        # for instances behind a load balancer where it was registered once for all of them.
+        self.webhook = WebhookServer(self.__receive_update, host=host, port=port, path=path, secret_token=secret_token)
+        self.metrics.collect('webhook', lambda: {'received': self.webhook.received, 'rejected': self.webhook.rejected})
+        if url is not None:
+            self.set_webhook(url, secret_token=secret_token, max_connections=max_connections)
+
+        self.running = True
+        self.__start_scheduler()
+        self.webhook.start()
+        logger.info('Listening for webhook updates on %s:%d%s', host, self.webhook.port, path)
+        try:
+            while self.running:
+                self.stopped.wait(self.dump_interval)
+                self.dump_state()
+        except KeyboardInterrupt:
+            pass
+
+        self.webhook.shutdown()
+        self.exit_gracefully()
+
+    def run_queue(self, updates: queue.Queue, processed: queue.Queue = None):
+        # Sharded mode: the updates of this shard's chats are routed here by ShardedBot, which also keeps track of the
+        # last processed update from the ids put in processed. None stops the shard.
+        self.last_processed_update_id = None
+        self.running = True
+        self.__start_scheduler()
+        next_dump = time.monotonic() + self.dump_interval
+        try:
+            while self.running:
+                try:
+                    update = updates.get(timeout=max(next_dump - time.monotonic(), 0))
+                except queue.Empty:
+                    update = {}
+
+                if update is None:
+                    break
+                if update:
+                    self.process_update(update)
+                    if processed is not None:
+                        processed.put(update['update_id'])
+
+                if time.monotonic() >= next_dump:
+                    self.dump_state()
+                    next_dump = time.monotonic() + self.dump_interval
+        except KeyboardInterrupt:
+            pass
+
+        self.exit_gracefully()
+
+    def set_webhook(self, url: str, secret_token: str = None, max_connections: int = 40):
+        set_webhook(self.session, self.base_url, url, secret_token=secret_token, max_connections=max_connections, timeout=self.timeout)
+
+    def __receive_update(self, update: dict):
+        # Called from the webhook server's threads, several at once
+        if self.dispatcher is None:
+            # Inline handling stays one update at a time, like polling
+            with self.inline_lock:
+                processed = self.process_update(update)
+        else:
+            processed = self.process_update(update)
+
+        if processed:
+            with self.state_lock:
+                if self.last_processed_update_id is None or update['update_id'] > self.last_processed_update_id:
+                    self.last_processed_update_id = update['update_id']
+
+    def stop(self):
+        # run() returns after the current getUpdates batch, run_webhook() right away
+        self.running = False
+        self.stopped.set()
+
+    def get_scraper(self, currency: str) -> eShop_Prices:
+        # Scrapers only carry the currency, so every chat using it shares one
+        with self.scrapers_lock:
+            if currency not in self.scrapers:
+                self.scrapers[currency] = eShop_Prices(currency=currency, cache=self.prices_cache, session=self.scraper_session, timeout=self.timeout, base_url=self.eshop_url, catalog=self.catalog,
+                                                        flights=self.flights, history=self.history, metrics=self.metrics, rates=self.rates)
+
+            return self.scrapers[currency]
+
+    def owns(self, chat_id: int) -> bool:
+        return chat_id % self.shards == self.shard
+
+    def get_interaction(self, chat_id: int) -> InteractionManager:
+        # Locked since updates, scheduled jobs and evict_idle_chats() can all get here from different threads
+        with self.state_lock:
+            interaction = self.ongoing_interactions.get(chat_id)
+            if interaction is None:
+                state = self.store.load_chat(chat_id)
+                if state is not None:
+                    interaction = InteractionManager.load(self, state)
+                else:
+                    interaction = InteractionManager(chat_id, self)
+
+                # Chats of other shards (promos check_promos found for them) are only borrowed, their own shard keeps
+                # their state and is the only one writing it
+                if not self.owns(chat_id):
+                    return interaction
+                self.ongoing_interactions[chat_id] = interaction
+
+            self.last_access[chat_id] = time.time()
+
+        return interaction
+
+    def evict_idle_chats(self):
+        cutoff = time.time() - self.idle_timeout
+
+        # Chats with unsaved changes stay until dump_state() has written them
+        with self.state_lock:
+            idle_chats = [chat_id for chat_id in self.ongoing_interactions if self.last_access.get(chat_id, 0) < cutoff and chat_id not in self.dirty_chats]
+            for chat_id in idle_chats:
+                del self.ongoing_interactions[chat_id]
+                self.last_access.pop(chat_id, None)
+
+        if len(idle_chats) > 0:
+            logger.info('Evicted %d idle chats, %d still in memory', len(idle_chats), len(self.ongoing_interactions))
+
+    def process_update(self, update) -> bool:
+        if 'message' in update.keys():
+            message = update['message']
+
+            chat_id = message['chat']['id']
+            self.__dispatch(chat_id, command_name(message.get('text')), self.get_interaction(chat_id).handle_message, message)
+
+        elif 'callback_query' in update.keys():
+            chat_id = update['callback_query']['message']['chat']['id']
+            self.__dispatch(chat_id, command_name(update['callback_query'].get('data')), self.get_interaction(chat_id).handle_callback, update['callback_query'])
+
+        else:
+            logger.debug('Skipping update %s, it is neither a message nor a callback query', update.get('update_id'))
+            return False
+
+        return True
+
+    def __dispatch(self, chat_id: int, command: str, handler, *args):
+        if self.dispatcher is None:
+            self.__handle(chat_id, command, time.perf_counter(), handler, *args)
+        else:
+            # Blocks while max_in_flight jobs are pending, which keeps getUpdates from running ahead
+            self.dispatcher.submit(chat_id, self.__handle, chat_id, command, time.perf_counter(), handler, *args)
+
+    def __handle(self, chat_id: int, command: str, dispatched_at: float, handler, *args):
+        # command_seconds covers the time spent waiting behind other jobs as well as handling
+        try:
+            handler(*args)
+        except requests.exceptions.RequestException as e:
+            # The update is handled all the same, so it isn't retried (and fails again) forever
+            self.metrics.inc('command_errors_total', command=command)
+            logger.warning('Could not handle %s for chat %d: %s', command, chat_id, e)
+            if command != 'promo':
+                self.send_message(chat_id, 'eshop\\-prices\\.com could not be reached, try again later')
+        except Exception:
+            self.metrics.inc('command_errors_total', command=command)
+            raise
+        finally:
+            self.metrics.observe('command_seconds', time.perf_counter() - dispatched_at, command=command)
+            # Marked once the handler is done, so the next dump_state() sees the chat's updated state
+            with self.state_lock:
+                self.dirty_chats.add(chat_id)
 
     def dump_state(self):
-        with open('last_processed_update_id', 'w') as lpui_file:
-            lpui_file.write(f'{self.last_processed_update_id}')
-        
-        with open('ongoing_interactions', 'w') as oi_file:
-            oi_json = {}
-            for chat_id in self.ongoing_interactions:
-                oi_json[int(chat_id)] = self.ongoing_interactions[chat_id].json()
-            
-            json.dump(oi_json, oi_file)
+        # Only chats, cache entries and promos that changed since the last dump are written
+        with self.state_lock:
+            dirty_chats, self.dirty_chats = self.dirty_chats, set()
+            new_informed_users, self.new_informed_users = self.new_informed_users, []
+            forgotten_promos, self.forgotten_promos = self.forgotten_promos, []
+            new_price_hashes, self.new_price_hashes = self.new_price_hashes, []
+        cache_entries, removed_cache_keys = self.prices_cache.take_changes()
+        interactions = {chat_id: self.ongoing_interactions[chat_id] for chat_id in dirty_chats if chat_id in self.ongoing_interactions}
+
+        meta = {}
+        if self.last_processed_update_id is not None:
+            meta['last_processed_update_id'] = str(self.last_processed_update_id)
+        if self.shard == 0:
+            meta['catalog_crawl_page'] = str(self.catalog.crawl_page)
+            meta['catalog_complete'] = '1' if self.catalog.complete else '0'
+            meta['promos_checked_at'] = str(self.promos_checked_at)
 
-        with open('prices_cache', 'w') as cache_file:
-            for cached_game in self.prices_cache:
-                self.prices_cache[cached_game]['date_added'] = str(self.prices_cache[cached_game]['date_added'])
-            json.dump(self.prices_cache, cache_file)
+        self.store.save(
+            chats={chat_id: interaction.json() for chat_id, interaction in interactions.items()},
+            cache_entries=cache_entries,
+            removed_cache_keys=removed_cache_keys,
+            informed_users=new_informed_users,
+            forgotten_promos=forgotten_promos,
+            meta=meta,
+            games=self.catalog.take_changes(),
+            subscriptions={chat_id: interaction.subscriptions() for chat_id, interaction in interactions.items()},
+            price_hashes=new_price_hashes
+        )
     
     def exit_gracefully(self):
+        self.stopped.set()
+
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+
+        # Replies to the updates handled so far still go out before exiting
+        self.outbox.close(timeout=60)
+
         self.dump_state()
+        self.metrics.shutdown()
 
 if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='eShop prices Telegram bot')
+    argument_parser.add_argument('--workers', type=int, default=0, help='threads handling updates (0 handles them inline)')
+    argument_parser.add_argument('--shards', type=int, default=1, help='processes sharing the chats (by chat id) and the state database')
+    argument_parser.add_argument('--webhook', action='store_true', help='receive updates on a local HTTP endpoint instead of polling getUpdates')
+    argument_parser.add_argument('--webhook-url', help='public URL to register with setWebhook (leave out if it is already registered)')
+    argument_parser.add_argument('--host', default='0.0.0.0')
+    argument_parser.add_argument('--port', type=int, default=8443)
+    argument_parser.add_argument('--path', default='/')
+    argument_parser.add_argument('--secret-token', help='secret Telegram sends back with every webhook update')
+    argument_parser.add_argument('--metrics-host', default='127.0.0.1')
+    argument_parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port at /metrics')
+    argument_parser.add_argument('--no-metrics', action='store_true', help='do not keep any metrics')
+    argument_parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    args = argument_parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
     with open('token') as token_file:
         token = token_file.read()
 
-    print(token)
-    
-    TelegramBot(token).run()
\ No newline at end of file
+    if args.shards > 1:
+        from ShardedBot import ShardedBot
+
+        bot = ShardedBot(token, shards=args.shards, workers=args.workers, log_level=args.log_level, metrics_enabled=not args.no_metrics,
+                         metrics_host=args.metrics_host, metrics_port=args.metrics_port)
+    else:
+        metrics = Metrics(enabled=not args.no_metrics)
+        if args.metrics_port is not None and metrics.enabled:
+            metrics.serve(args.metrics_host, args.metrics_port)
+
+        bot = TelegramBot(token, workers=args.workers, metrics=metrics)
+
+    if args.webhook or args.webhook_url is not None:
+        bot.run_webhook(url=args.webhook_url, host=args.host, port=args.port, path=args.path, secret_token=args.secret_token)
+    else:
+        bot.run()
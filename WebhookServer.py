@@ -0,0 +1,83 @@
+import json
+import logging
+import threading
+import http.server
+
+logger = logging.getLogger(__name__)
+
+class WebhookServer:
+    # Local HTTP endpoint for Telegram's setWebhook. Every POSTed Update is handed to handle_update, the server only
+    # answers once it has been accepted so Telegram redelivers updates that failed.
+    def __init__(self, handle_update, host: str = '0.0.0.0', port: int = 8443, path: str = '/', secret_token: str = None):
+        self.handle_update = handle_update
+        self.path = path
+        self.secret_token = secret_token
+
+        self.received = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer((host, port), self.__handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    def __handler_class(self):
+        webhook = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                if self.path.split('?', 1)[0] != webhook.path:
+                    return self.respond(404)
+
+                # Telegram sends the secret_token given to setWebhook with every update
+                if webhook.secret_token is not None and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook.secret_token:
+                    webhook.count(rejected=True)
+                    return self.respond(403)
+
+                try:
+                    update = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                except ValueError:
+                    webhook.count(rejected=True)
+                    return self.respond(400)
+
+                try:
+                    webhook.handle_update(update)
+                except Exception:
+                    logger.exception('Error handling webhook update')
+                    return self.respond(500)
+
+                webhook.count()
+                self.respond(200)
+
+            def respond(self, status: int):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def count(self, rejected: bool = False):
+        with self.lock:
+            if rejected:
+                self.rejected += 1
+            else:
+                self.received += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='webhook', daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eShop_Prices import eShop_Prices
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# fixture name -> (path on eshop-prices.com, parser method that handles it)
+FIXTURES = {
+    'game': ('games/5334-super-mario-3d-world-bowser-s-fury', 'parse_prices_table'),
+    'search': ('games?q=mario', 'parse_games_list'),
+    'on_sale': ('games/on-sale?direction=desc&sort_by=discount', 'parse_games_list'),
+    'home': ('', 'parse_currency_select')
+}
+
+def fixture_path(name: str) -> str:
+    return os.path.join(FIXTURES_DIR, f'{name}.html')
+
+def load_fixture(name: str) -> str:
+    with open(fixture_path(name), encoding='utf-8') as fixture_file:
+        return fixture_file.read()
+
+def record_fixtures(currency: str = ''):
+    # Replaces the saved pages with what eshop-prices.com currently serves
+    scraper = eShop_Prices(currency=currency)
+
+    for name, (path, _) in FIXTURES.items():
+        request_url = scraper.base_url + path
+        if currency != '':
+            request_url += ('&' if '?' in path else '?') + f'currency={currency}'
+
+        response = scraper._get(request_url)
+        if response.status_code != 200:
+            print(f'Could not record {name} (Status = {response.status_code})')
+            continue
+
+        with open(fixture_path(name), 'w', encoding='utf-8') as fixture_file:
+            fixture_file.write(response.text)
+        print(f'Recorded {name} from {request_url} ({len(response.text)} chars)')
@@ -0,0 +1,336 @@
+import os
+import re
+import gzip
+import html
+import hashlib
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import concurrent.futures
+import urllib.parse
+import http.server
+
+import requests
+
+from Fixtures import load_fixture
+
+from TelegramBot import TelegramBot
+from ShardedBot import ShardedBot
+
+GAMES_LIST_ITEM_REGEX = re.compile('<a class="games-list-item".*?</a>', re.DOTALL)
+
+class FakeTelegram:
+    # Just enough of the Bot API for TelegramBot: getUpdates hands out the synthetic updates as they become due,
+    # and every sendMessage/editMessageText answers the oldest pending update of that chat.
+    # With flood_interval set, messages to a chat closer together than that get a 429 like the real API sends.
+    def __init__(self, poll_wait: float = 0.5, flood_interval: float = 0):
+        self.poll_wait = poll_wait
+        self.flood_interval = flood_interval
+        self.last_message_at = {}  # chat_id -> time of its last accepted message
+
+        self.lock = threading.Lock()
+        self.updates = []  # (due_at, update)
+        self.pending = {}  # chat_id -> [due_at, ...]
+        self.latencies = []
+        self.calls = {}
+        self.new_update = threading.Condition(self.lock)
+
+    def add_updates(self, updates: [(float, dict)]):
+        with self.lock:
+            self.updates.extend(updates)
+            self.updates.sort(key=lambda due_update: due_update[0])
+            for due_at, update in updates:
+                self.pending.setdefault(chat_id_of(update), []).append(due_at)
+            self.new_update.notify_all()
+
+    def push_updates(self, webhook_url: str, updates: [(float, dict)], connections: int = 8):
+        # Webhook mode: POST each update to the bot once it is due, over a few connections at a time like Telegram does
+        def push():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor, requests.Session() as session:
+                for due_at, update in sorted(updates, key=lambda due_update: due_update[0]):
+                    time.sleep(max(0, due_at - time.perf_counter()))
+                    executor.submit(session.post, webhook_url, json=update, timeout=60)
+
+        threading.Thread(target=push, daemon=True).start()
+
+    def outstanding(self) -> int:
+        with self.lock:
+            return sum(len(due) for due in self.pending.values())
+
+    def handle(self, method: str, params: {str: str}) -> dict:
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset', 0)))
+
+        if method in ('sendMessage', 'editMessageText'):
+            now = time.perf_counter()
+            chat_id = int(params['chat_id'])
+            with self.lock:
+                if now - self.last_message_at.get(chat_id, -self.flood_interval) < self.flood_interval:
+                    self.calls['429'] = self.calls.get('429', 0) + 1
+                    return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}}
+                self.last_message_at[chat_id] = now
+
+                due = self.pending.get(chat_id, [])
+                if len(due) > 0:
+                    self.latencies.append(now - due.pop(0))
+
+        return {'ok': True, 'result': True}
+
+    def get_updates(self, offset: int) -> dict:
+        deadline = time.perf_counter() + self.poll_wait
+        with self.lock:
+            while True:
+                now = time.perf_counter()
+                ready = [update for due_at, update in self.updates if due_at <= now and update['update_id'] >= offset][:100]
+                if len(ready) > 0 or now >= deadline:
+                    return {'ok': True, 'result': ready}
+                self.new_update.wait(timeout=min(deadline - now, 0.01))
+
+class FakeEshop:
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.stats = {}
+
+        self.pages = {name: load_fixture(name) for name in ('game', 'search', 'on_sale', 'home')}
+        self.search_items = GAMES_LIST_ITEM_REGEX.findall(self.pages['search'])
+
+    def handle(self, path: str, params: {str: str}) -> str:
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+        if path == '/':
+            return self.pages['home']
+        if path == '/games/on-sale':
+            return self.pages['on_sale']
+        if path == '/games':
+            # Only keep the results that mention the query, so specific titles resolve to a single game
+            query = params.get('q', '').lower()
+            items = [item for item in self.search_items if query in html.unescape(item).lower()]
+            return GAMES_LIST_ITEM_REGEX.sub('', self.pages['search']).replace('<div class="games-list">', '<div class="games-list">' + '\n'.join(items), 1)
+        return self.pages['game']
+
+def serve(handler_function, stats: {str: int} = None) -> http.server.ThreadingHTTPServer:
+    # HTML pages get an ETag (answering a matching If-None-Match with a 304) and are gzipped when the client accepts it,
+    # stats (when given) counts the bytes sent and the 304s
+    stats_lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            self.respond(url.path, params)
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params = json.loads(body)
+            else:
+                params = dict(urllib.parse.parse_qsl(body.decode()))
+            self.respond(url.path, params)
+
+        def respond(self, path: str, params: {str: str}):
+            status = 200
+            headers = {}
+            body = handler_function(re.sub('/+', '/', path), params)
+            if isinstance(body, tuple):
+                status, body = body
+            if isinstance(body, dict):
+                body, headers['Content-Type'] = json.dumps(body).encode(), 'application/json'
+            else:
+                body, headers['Content-Type'] = body.encode(), 'text/html; charset=utf-8'
+                headers['ETag'] = f'"{hashlib.sha1(body).hexdigest()}"'
+                if self.headers.get('If-None-Match') == headers['ETag']:
+                    status, body = 304, b''
+                elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body, headers['Content-Encoding'] = gzip.compress(body), 'gzip'
+
+            if stats is not None:
+                with stats_lock:
+                    stats['bytes_sent'] = stats.get('bytes_sent', 0) + len(body)
+                    stats['not_modified'] = stats.get('not_modified', 0) + (status == 304)
+
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+def chat_id_of(update: dict) -> int:
+    if 'message' in update:
+        return update['message']['chat']['id']
+    return update['callback_query']['message']['chat']['id']
+
+def synthetic_updates(count: int, chats: int, rate: float, mix: {str: float}, games: [(str, int)], start: float) -> [(float, dict)]:
+    updates = []
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+
+    for update_id in range(count):
+        chat_id = random.randrange(chats) + 1
+        title, game_id = random.choice(games)
+        due_at = start + (update_id / rate if rate > 0 else 0)
+        kind = random.choices(kinds, weights)[0]
+
+        if kind == 'callback':
+            update = {
+                'update_id': update_id,
+                'callback_query': {
+                    'data': f'/prices id:{game_id}',
+                    'message': {
+                        'message_id': update_id,
+                        'chat': {'id': chat_id},
+                        'reply_markup': {'inline_keyboard': [[{'text': f'{title} (R$ 1,00)', 'callback_data': f'/prices id:{game_id}'}]]}
+                    }
+                }
+            }
+        else:
+            update = {
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'chat': {'id': chat_id},
+                    'text': f'/{kind} {title}'
+                }
+            }
+
+        updates.append((due_at, update))
+
+    return updates
+
+def percentile(values: [float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run(args) -> {str: float}:
+    telegram = FakeTelegram(flood_interval=args.flood_interval)
+    eshop = FakeEshop(latency=args.eshop_latency)
+    telegram_server = serve(lambda path, params: telegram.handle(path.rsplit('/', 1)[-1], params))
+    eshop_server = serve(eshop.handle, eshop.stats)
+
+    # Titles that match exactly one game in the search fixture, so /prices goes all the way to the prices page
+    games = [(html.unescape(re.search('<h5>(.*?)</h5>', item).group(1)), int(re.search('/games/(\\d+)', item).group(1))) for item in eshop.search_items]
+    games = [(title, game_id) for title, game_id in games if sum(title.lower() in html.unescape(item).lower() for item in eshop.search_items) == 1]
+
+    mix = {kind: float(weight) for kind, weight in (entry.split('=') for entry in args.mix.split(','))}
+
+    # TelegramBot keeps its state files in the working directory
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as state_dir:
+        os.chdir(state_dir)
+        bot_args = {
+            'workers': args.workers,
+            'pool_size': args.pool_size,
+            'send_workers': args.send_workers,
+            'chat_send_rate': args.chat_send_rate,
+            'api_url': f'http://127.0.0.1:{telegram_server.server_port}',
+            'eshop_url': f'http://127.0.0.1:{eshop_server.server_port}/'
+        }
+        # Sharded bots keep their caches and metrics in the shard processes, so those aren't reported
+        if args.shards > 1:
+            bot = ShardedBot('loadtest', shards=args.shards, metrics_enabled=args.metrics_out is None, **bot_args)
+        else:
+            bot = TelegramBot('loadtest', **bot_args)
+
+        if args.webhook:
+            bot_thread = threading.Thread(target=bot.run_webhook, kwargs={'host': '127.0.0.1', 'port': 0}, daemon=True)
+        else:
+            bot_thread = threading.Thread(target=bot.run, daemon=True)
+        bot_thread.start()
+
+        start = time.perf_counter()
+        updates = synthetic_updates(args.updates, args.chats, args.rate, mix, games, start)
+        if args.webhook:
+            while bot.webhook is None:
+                time.sleep(0.01)
+            # Only used to account for the replies, getUpdates isn't called in webhook mode
+            telegram.add_updates(updates)
+            telegram.push_updates(f'http://127.0.0.1:{bot.webhook.port}/', updates)
+        else:
+            telegram.add_updates(updates)
+
+        deadline = start + args.timeout
+        while telegram.outstanding() > 0 and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        bot.stop()
+        bot_thread.join()
+
+        os.chdir(working_dir)
+
+    telegram_server.shutdown()
+    eshop_server.shutdown()
+
+    if args.metrics_out is not None and args.shards == 1:
+        with open(args.metrics_out, 'w') as metrics_file:
+            metrics_file.write(bot.metrics.render())
+
+    latencies = telegram.latencies
+    return {
+        'updates': args.updates,
+        'answered': len(latencies),
+        'seconds': elapsed,
+        'updates_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p90_ms': percentile(latencies, 90) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'max_ms': max(latencies) * 1000 if latencies else None,
+        'eshop_requests': eshop.requests,
+        'eshop_bytes_sent': eshop.stats.get('bytes_sent', 0),
+        'eshop_not_modified': eshop.stats.get('not_modified', 0),
+        'telegram_calls': telegram.calls,
+        'shards': args.shards,
+        'routed': bot.routed if args.shards > 1 else None,
+        'cache': bot.prices_cache.stats() if args.shards == 1 else None,
+        'flights': bot.flights.stats() if args.shards == 1 else None,
+        'messages': bot.messages.stats() if args.shards == 1 else None,
+        'outbox': bot.outbox.stats() if args.shards == 1 else None
+    }
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Drive TelegramBot.run with synthetic updates against local fake Telegram and eshop-prices servers')
+    argument_parser.add_argument('--updates', type=int, default=2000)
+    argument_parser.add_argument('--chats', type=int, default=500)
+    argument_parser.add_argument('--rate', type=float, default=0, help='updates released per second (0 releases them all at once)')
+    argument_parser.add_argument('--mix', default='prices=0.5,addfavorite=0.2,callback=0.3', help='weights of each update kind')
+    argument_parser.add_argument('--workers', type=int, default=0, help='TelegramBot workers (0 handles updates inline)')
+    argument_parser.add_argument('--shards', type=int, default=1, help='run the bot as a ShardedBot with this many processes')
+    argument_parser.add_argument('--webhook', action='store_true', help='push updates to TelegramBot.run_webhook instead of serving getUpdates')
+    argument_parser.add_argument('--pool-size', type=int, default=10)
+    argument_parser.add_argument('--send-workers', type=int, default=4, help='threads draining the TelegramBot outbox')
+    argument_parser.add_argument('--chat-send-rate', type=float, default=1, help='messages per second TelegramBot sends to one chat (0 for no limit)')
+    argument_parser.add_argument('--flood-interval', type=float, default=0, help='seconds the fake Telegram wants between messages to a chat (0 never answers 429)')
+    argument_parser.add_argument('--eshop-latency', type=float, default=0.05, help='seconds the fake eshop-prices.com takes per page')
+    argument_parser.add_argument('--timeout', type=float, default=300, help='give up waiting for replies after this many seconds')
+    argument_parser.add_argument('--seed', type=int, default=0)
+    argument_parser.add_argument('--metrics-out', help='write the bot\'s metrics (Prometheus text format) to this file')
+    args = argument_parser.parse_args()
+
+    random.seed(args.seed)
+    results = run(args)
+
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if results['answered'] == results['updates'] else 1)
@@ -0,0 +1,139 @@
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+from Fixtures import FIXTURES, load_fixture, record_fixtures
+
+from Parsers import PARSERS, get_parser
+
+def time_parse(parse, text: str, min_time: float) -> (int, float):
+    # Runs parse until at least min_time seconds have passed, returns (iterations, seconds)
+    parse(text)
+
+    iterations = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time:
+        parse(text)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+
+    return iterations, elapsed
+
+def peak_memory(parse, text: str) -> int:
+    tracemalloc.start()
+    try:
+        parse(text)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+def chunked(data: bytes, chunk_size: int) -> [bytes]:
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+def stream_parse(parser, chunk_size: int):
+    # iter_prices_table fed the page the way a streamed download would arrive
+    def parse(text: str) -> list:
+        return list(parser.iter_prices_table(iter(chunked(text.encode(), chunk_size)), 'utf-8'))
+
+    return parse
+
+def first_row_ms(parser, text: str, chunk_size: int) -> float:
+    chunks = chunked(text.encode(), chunk_size)
+    start = time.perf_counter()
+    next(parser.iter_prices_table(iter(chunks), 'utf-8'), None)
+
+    return (time.perf_counter() - start) * 1000
+
+def run(parser_names: [str], fixture_names: [str], min_time: float, chunk_size: int = 16 * 1024) -> {str: {str: float}}:
+    results = {}
+
+    for fixture_name in fixture_names:
+        text = load_fixture(fixture_name)
+        method = FIXTURES[fixture_name][1]
+
+        # Prices pages are also parsed the streamed way, as '<parser>-stream'
+        benchmarks = [(parser_name, getattr(get_parser(parser_name), method)) for parser_name in parser_names]
+        if method == 'parse_prices_table':
+            benchmarks += [(f'{parser_name}-stream', stream_parse(get_parser(parser_name), chunk_size)) for parser_name in parser_names]
+
+        reference = None
+        for parser_name, parse in benchmarks:
+            output = parse(text)
+            iterations, elapsed = time_parse(parse, text, min_time)
+            peak = peak_memory(parse, text)
+
+            if reference is None:
+                reference = output
+
+            rows = max(len(output), 1)
+            results[f'{fixture_name}/{parser_name}'] = {
+                'pages_per_sec': iterations / elapsed,
+                'ms_per_page': elapsed / iterations * 1000,
+                'us_per_row': elapsed / iterations / rows * 1000000,
+                'rows': len(output),
+                'peak_kib': peak / 1024,
+                'matches_reference': output == reference
+            }
+            if parser_name.endswith('-stream'):
+                results[f'{fixture_name}/{parser_name}']['first_row_ms'] = first_row_ms(get_parser(parser_name[:-len('-stream')]), text, chunk_size)
+
+    return results
+
+def report(results: {str: {str: float}}, baseline: {str: {str: float}} = None, tolerance: float = 0.2) -> bool:
+    print(f'{"benchmark":<24}{"pages/s":>10}{"ms/page":>10}{"us/row":>10}{"rows":>6}{"peak KiB":>10}  notes')
+
+    ok = True
+    for name, result in results.items():
+        notes = []
+        if 'first_row_ms' in result:
+            notes.append(f'first row after {result["first_row_ms"]:.3f} ms')
+        if not result['matches_reference']:
+            notes.append('OUTPUT DIFFERS FROM FIRST PARSER')
+            ok = False
+
+        if baseline is not None and name in baseline:
+            change = result['pages_per_sec'] / baseline[name]['pages_per_sec'] - 1
+            notes.append(f'{change:+.0%} vs baseline')
+            if change < -tolerance:
+                notes.append('REGRESSION')
+                ok = False
+
+        print(f'{name:<24}{result["pages_per_sec"]:>10.1f}{result["ms_per_page"]:>10.3f}{result["us_per_row"]:>10.1f}{result["rows"]:>6}{result["peak_kib"]:>10.1f}  {", ".join(notes)}')
+
+    return ok
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Offline benchmark of the eshop-prices.com page parsers')
+    argument_parser.add_argument('--parsers', nargs='+', default=list(PARSERS), choices=list(PARSERS))
+    argument_parser.add_argument('--fixtures', nargs='+', default=list(FIXTURES), choices=list(FIXTURES))
+    argument_parser.add_argument('--min-time', type=float, default=1.0, help='seconds to spend on each benchmark')
+    argument_parser.add_argument('--chunk-size', type=int, default=16 * 1024, help='bytes per chunk fed to the streamed parsers')
+    argument_parser.add_argument('--save', help='write the results to this JSON file')
+    argument_parser.add_argument('--baseline', help='compare against results saved with --save')
+    argument_parser.add_argument('--tolerance', type=float, default=0.2, help='allowed pages/s drop before flagging a regression')
+    argument_parser.add_argument('--record', action='store_true', help='download fresh fixtures from eshop-prices.com first')
+    argument_parser.add_argument('--currency', default='', help='currency to record fixtures in')
+    args = argument_parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.currency)
+
+    results = run(args.parsers, args.fixtures, args.min_time, args.chunk_size)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    ok = report(results, baseline, args.tolerance)
+
+    if args.save is not None:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2)
+
+    sys.exit(0 if ok else 1)
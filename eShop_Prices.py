@@ -1,138 +1,258 @@
-import bs4
 import urllib
+import logging
 import requests
-import lxml
 import cchardet
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+
+from PricesCache import PricesCache
+from Parsers import get_parser
+from GameCatalog import GameCatalog
+from SingleFlight import SingleFlight
+from PriceHistory import PriceHistory
+from Price import Price
+from Metrics import Metrics
+from ExchangeRates import ExchangeRates
+
+logger = logging.getLogger(__name__)
+
+def build_session(pool_size: int = 10, retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+    # Keep-alive session that reuses up to pool_size connections per host and backs off on 429/5xx
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
 
 class eShop_Prices:
-    def __init__(self, currency=''):
-        self.base_url = 'https://eshop-prices.com/'
+    # Pages are only scraped (and cached) in their canonical form, without a currency, and converted to the scraper's
+    # currency with the shared ExchangeRates, so scrapers of every currency share the same cache entries
+    CANONICAL = ''
+
+    def __init__(self, currency='', cache: PricesCache = None, session: requests.Session = None, timeout: float = 15, parser: str = 'lxml', base_url: str = 'https://eshop-prices.com/',
+                 catalog: GameCatalog = None, flights: SingleFlight = None, history: PriceHistory = None, validators_ttl: int = 7 * 24 * 60 * 60,
+                 stream: bool = True, chunk_size: int = 16 * 1024, metrics: Metrics = None, top_discounts_ttl: int = 30 * 60,
+                 rates: ExchangeRates = None):
+        self.base_url = base_url
+        self.headers = {
+            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0',
+            # Includes br (and zstd) when urllib3 can decode them
+            'Accept-Encoding': ACCEPT_ENCODING
+        }
+        self.timeout = timeout
+
+        # Prices pages are parsed while they download (stream=True) and only read up to the end of the prices table.
+        # A remainder of up to drain_limit bytes is still read so the connection can go back to the pool.
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.drain_limit = 64 * 1024
+
+        # ETag/Last-Modified of every page fetched, kept with what was parsed from it for validators_ttl seconds
+        self.validators_ttl = validators_ttl
+        self.requests = 0
+        self.not_modified = 0
 
         self.currency = currency
+        self.rates = rates
+        self.cache = cache if cache is not None else PricesCache()
+        self.top_discounts_ttl = top_discounts_ttl
+        self.session = session if session is not None else build_session()
+        self.parser = get_parser(parser)
+
+        # Searches are answered from the catalog when it can, and every games list we fetch is added to it
+        self.catalog = catalog
+
+        # Identical fetches running at the same time (a sale burst of /prices for one game) share one request.
+        # Keys are the cache keys, so one SingleFlight can be shared by every scraper.
+        self.flights = flights if flights is not None else SingleFlight()
+
+        # Every prices table actually scraped (not served from the cache) is recorded here
+        self.history = history
+
+        # Fetch and parse timings per page kind, responses per status and cache hits (nothing is kept when disabled)
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+    def _get(self, request_url: str, headers: {str: str} = None, stream: bool = False) -> requests.Response:
+        self.requests += 1
+        return self.session.get(request_url, headers=headers if headers is not None else self.headers, timeout=self.timeout, stream=stream)
+
+    def _get_parsed(self, request_url: str, parse, page: str, stream: bool = False) -> (int, object):
+        # Pages are requested with the validators they were last served with, so an unchanged page comes back as
+        # an empty 304 and what was parsed from it last time is reused. Returns the status and the parsed page (or None).
+        # With stream=True parse is given the body's chunks and the charset from the headers (or None) instead of the text.
+        validators_key = PricesCache.validators_key(request_url)
+        validated = self.cache.get(validators_key)
+
+        headers = self.headers
+        if validated is not None:
+            headers = dict(self.headers)
+            if validated['etag'] is not None:
+                headers['If-None-Match'] = validated['etag']
+            if validated['last_modified'] is not None:
+                headers['If-Modified-Since'] = validated['last_modified']
 
-    def __parse_games_list_item(self, games_list_item: bs4.element.Tag) -> (str, str):
-        game_title = games_list_item.find_all('h5')[0].string
-        game_url = games_list_item['href']
-        for i, s in enumerate(games_list_item.find_all('span', {'class': 'price-tag'})[0].strings):
-            print(i, s)
         try:
-            game_price = list(games_list_item.find_all('span', {'class': 'price-tag'})[0].strings)[2].strip()
-        except IndexError:
-            game_price = list(games_list_item.find_all('span', {'class': 'price-tag'})[0].strings)[0].strip()
-
-        return {
-            'game_title': game_title,
-            'game_uri': game_url,
-            'game_price': game_price
-        }
+            with self.metrics.timer('eshop_fetch_seconds', page=page):
+                response = self._get(request_url, headers, stream)
+        except requests.exceptions.RequestException:
+            self.metrics.inc('eshop_errors_total', page=page)
+            raise
+
+        with response:
+            self.metrics.inc('eshop_responses_total', page=page, status=response.status_code)
+            if response.status_code == 304 and validated is not None:
+                self.not_modified += 1
+                return response.status_code, validated['value']
+            if response.status_code != 200:
+                logger.warning('Got status %d for %s', response.status_code, request_url)
+                return response.status_code, None
+
+            # Streamed pages are still downloading while they are parsed, so that time counts as parsing here
+            with self.metrics.timer('eshop_parse_seconds', page=page):
+                if stream:
+                    chunks = response.iter_content(self.chunk_size)
+                    value = parse(chunks, response.encoding if 'charset=' in response.headers.get('Content-Type', '') else None)
+                    self.__drain(chunks)
+                else:
+                    value = parse(response.text)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is not None or last_modified is not None:
+            self.cache.put(validators_key, {'etag': etag, 'last_modified': last_modified, 'value': value}, ttl=self.validators_ttl)
+
+        return response.status_code, value
+
+    def __drain(self, chunks):
+        # Past drain_limit the connection is simply closed with the response
+        drained = 0
+        for chunk in chunks:
+            drained += len(chunk)
+            if drained > self.drain_limit:
+                break
+
+    def get_prices_from_url(self, game_url: str, refresh: bool = False) -> [Price]:
+        # refresh=True skips the cache and scrapes the page again (still conditionally), to renew an entry before it expires
+        return self.__convert_prices(self.__get_canonical_prices(game_url, refresh))
+
+    def __get_canonical_prices(self, game_url: str, refresh: bool = False) -> [Price]:
+        cache_key = PricesCache.prices_key(game_url, self.CANONICAL)
+        if not refresh:
+            prices = self.cache.get(cache_key)
+            self.metrics.inc('eshop_cache_total', page='prices', result='hit' if prices is not None else 'miss')
+            if prices is not None:
+                return prices
+
+        return self.flights.do(cache_key, self.__fetch_prices, game_url, cache_key, refresh)
+
+    def __fetch_prices(self, game_url: str, cache_key: str, refresh: bool) -> [Price]:
+        # A flight for this key may have finished between the cache lookup and joining the flight
+        prices = self.cache.get(cache_key) if not refresh else None
+        if prices is not None:
+            return prices
 
-    def __parse_country_column(self, country_column: bs4.element.Tag) -> str:
-        try:
-            return list(country_column.strings)[3].strip()
-        except IndexError:
-            return list(country_column.strings)[0].strip()
-    
-    def __parse_price_column(self, price_column: bs4.element.Tag) -> str:
-        try:
-            original_price = price_column.div.find('del').string.strip()
-            discounted_price = list(price_column.div.strings)[2].strip()
-            return {
-                'current_price': discounted_price,
-                'original_price': original_price,
-                'discount': True
-            }
-        except AttributeError:
-            original_price = price_column.string.strip()
-            return {
-                'current_price': original_price,
-                'original_price': original_price,
-                'discount': False
-            }
-    
-    def __parse_prices_table_row(self, row):
-        columns = row.find_all('td')
+        status_code, prices = self.__fetch_prices_table(self.base_url + game_url, 'prices')
 
-        country = self.__parse_country_column(columns[1])
-        try:
-            meta = columns[2].span['title']
-        except TypeError:
-            meta = None
-        price = self.__parse_price_column(columns[3])
-
-        return {
-            'country': country,
-            'meta': meta,
-            'price': price
-        }
+        if prices is not None:
+            self.cache.put_prices(cache_key, prices)
 
-    def get_prices_from_url(self, game_url: str) -> [{str: str}]:
-        request_url = self.base_url + game_url # + f'?currency={self.currency}'
-        print('Making request to ' + request_url)
+            game_id = GameCatalog.game_id(game_url)
+            if self.history is not None and game_id is not None:
+                self.history.record(game_id, self.CANONICAL, prices)
 
-        response = requests.get(
-            request_url,
-            headers={
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0'
-            }
-        )
+            return prices
+        else:
+            return f'Error getting prices from game_url! (Status = {status_code})'
 
-        if response.status_code == 200:
-            soup = bs4.BeautifulSoup(response.text, 'lxml')
+    def __fetch_prices_table(self, request_url: str, page: str) -> (int, [Price]):
+        logger.debug('Making request to %s', request_url)
 
-            prices_table = soup.find_all('table', {'class': 'prices-table'})[0]
+        if self.stream:
+            return self._get_parsed(request_url, self.__parse_prices_stream, page, stream=True)
+        return self._get_parsed(request_url, self.parser.parse_prices_table, page)
 
-            prices = []
-            for row in prices_table.tbody.find_all('tr'):
-                #columns = row.find_all('td')
-                try:
-                    prices.append(
-                        self.__parse_prices_table_row(row)
-                    )
-                except IndexError as e:
-                    print(e, row)
+    def __parse_prices_stream(self, chunks, encoding: str) -> [Price]:
+        return list(self.parser.iter_prices_table(chunks, encoding))
 
+    def __convert_prices(self, prices: [Price]) -> [Price]:
+        if isinstance(prices, str) or self.rates is None or self.currency == self.CANONICAL:
             return prices
-        else:
-            return f'Error getting prices from game_url! (Status = {response.status_code})'
+        return self.rates.convert_prices(prices, self.currency)
 
-    def search(self, query: str) -> {str: str}:
-        encoded_query = urllib.parse.quote(query, safe='')
+    def __convert_results(self, results: {str: dict}) -> {str: dict}:
+        if isinstance(results, str) or self.rates is None or self.currency == self.CANONICAL:
+            return results
+        return self.rates.convert_results(results, self.currency)
 
-        request_url = self.base_url + f'games?q={encoded_query}&currency={self.currency}'
+    def learn_exchange_rates(self, game_url: str) -> int:
+        # Compares game_url's canonical prices with the same page in this scraper's currency. Returns how many
+        # currencies can be converted to it, 0 when nothing could be learned.
+        if self.rates is None or self.currency == self.CANONICAL:
+            return 0
 
-        response = requests.get(
-            request_url,
-            headers={
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0'
-            }
-            )
+        canonical = self.__get_canonical_prices(game_url)
+        if isinstance(canonical, str):
+            return 0
+
+        _, converted = self.__fetch_prices_table(self.base_url + game_url + f'?currency={self.currency}', 'exchange_rates')
+        if converted is None:
+            return 0
+
+        return self.rates.learn(self.currency, canonical, converted)
 
-        if response.status_code == 200:
-            soup = bs4.BeautifulSoup(response.text, 'lxml')
+    def search(self, query: str) -> {str: dict}:
+        return self.__convert_results(self.__search_canonical(query))
 
-            games_list = soup.find_all('a', {'class': 'games-list-item'})
+    def __search_canonical(self, query: str) -> {str: dict}:
+        cache_key = PricesCache.search_key(query, self.CANONICAL)
+        results = self.cache.get(cache_key)
+        if results is not None:
+            self.metrics.inc('eshop_cache_total', page='search', result='hit')
+            return results
+
+        if self.catalog is not None:
+            results = self.catalog.search(query, self.CANONICAL)
+            if results is not None:
+                self.metrics.inc('eshop_cache_total', page='search', result='catalog')
+                return results
 
-            results = {}
+        self.metrics.inc('eshop_cache_total', page='search', result='miss')
 
-            for games_list_item in games_list:
-                games_list_item = self.__parse_games_list_item(games_list_item)
-                results[games_list_item['game_title']] = {
-                    'best_price': games_list_item['game_price'],
-                    'uri': games_list_item['game_uri']
-                }
+        return self.flights.do(cache_key, self.__fetch_search, query, cache_key)
 
+    def __fetch_search(self, query: str, cache_key: str) -> {str: dict}:
+        results = self.cache.get(cache_key)
+        if results is not None:
+            return results
+
+        encoded_query = urllib.parse.quote(query, safe='')
+
+        request_url = self.base_url + f'games?q={encoded_query}'
+
+        status_code, results = self._get_parsed(request_url, self.__parse_games_list, 'search')
+
+        if results is not None:
+            self.cache.put(cache_key, results)
             return results
         else:
-            return f'Error performing search! (Status = {response.status_code})'
-        pass
+            return f'Error performing search! (Status = {status_code})'
 
-    def get_prices(self, game: str) -> [{str: str}]:
+    def get_prices(self, game: str) -> [Price]:
         search_results = self.search(game)
 
         if len(search_results) == 0:
             pass
         elif len(search_results) == 1:
-            return self.get_prices_from_url(list(search_results.values())[0])
+            return self.get_prices_from_url(list(search_results.values())[0]['uri'])
         else:
             print('More than one game found from that query:')
             for i, game_title in enumerate(search_results.keys()):
@@ -142,48 +262,61 @@ class eShop_Prices:
 
             return self.get_prices_from_url(list(search_results.values())[int(game_to_get)]['uri'])
 
-    def get_top_discounts(self) -> [{str: str}]:
-        request_url = self.base_url + f'games/on-sale?direction=desc&sort_by=discount&currency={self.currency}'
+    def get_top_discounts(self, refresh: bool = False) -> {str: dict}:
+        cache_key = PricesCache.top_discounts_key(self.CANONICAL)
+        if not refresh:
+            results = self.cache.get(cache_key)
+            self.metrics.inc('eshop_cache_total', page='top_discounts', result='hit' if results is not None else 'miss')
+            if results is not None:
+                return self.__convert_results(results)
 
-        response = requests.get(
-            request_url,
-            headers={
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0'
-            }
-            )
+        return self.__convert_results(self.flights.do(cache_key, self.__fetch_top_discounts, cache_key, refresh))
+
+    def __fetch_top_discounts(self, cache_key: str, refresh: bool) -> {str: dict}:
+        results = self.cache.get(cache_key) if not refresh else None
+        if results is not None:
+            return results
 
-        soup = bs4.BeautifulSoup(response.text, 'lxml')
+        request_url = self.base_url + 'games/on-sale?direction=desc&sort_by=discount'
 
-        games_list = soup.find_all('a', {'class': 'games-list-item'})
+        _, results = self._get_parsed(request_url, self.__parse_games_list, 'top_discounts')
 
+        if results is None:
+            return {}
+
+        # Discounts change more often than prices, so these go stale sooner
+        self.cache.put(cache_key, results, ttl=self.top_discounts_ttl)
+        return results
+
+    def get_games_page(self, page: int) -> {str: dict}:
+        # Canonical, like everything the catalog is given
+        request_url = self.base_url + f'games?page={page}'
+
+        status_code, results = self._get_parsed(request_url, self.__parse_games_list, 'games')
+
+        if results is not None:
+            return results
+        else:
+            return f'Error getting games page {page}! (Status = {status_code})'
+
+    def __parse_games_list(self, text: str) -> {str: str}:
         results = {}
 
-        for games_list_item in games_list:
-            games_list_item = self.__parse_games_list_item(games_list_item)
+        for games_list_item in self.parser.parse_games_list(text):
             results[games_list_item['game_title']] = {
                 'best_price': games_list_item['game_price'],
                 'uri': games_list_item['game_uri']
             }
 
+        if self.catalog is not None:
+            self.catalog.add_results(results, self.CANONICAL)
+
         return results
     
     def get_available_currencies(self) -> {str: str}:
-        response = requests.get(
-            self.base_url,
-            headers={
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0'
-            }
-            )
-
-        soup = bs4.BeautifulSoup(response.text, 'lxml')
-        currency_select = soup.find_all('select', {'name': 'language-select'})[0]
-        options = currency_select.find_all('option')
+        _, currencies = self._get_parsed(self.base_url, self.parser.parse_currency_select, 'currencies')
 
-        result = {}
-        for option in options:
-            result[option['value']] = option.string
-        
-        return result
+        return currencies if currencies is not None else {}
 
 if __name__ == '__main__':
     game_query = input('Game to Query ? ')
@@ -0,0 +1,24 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GameCatalog import GameCatalog
+
+class GameCatalogSearchTest(unittest.TestCase):
+    def test_local_results_are_capped(self):
+        catalog = GameCatalog(max_results=30)
+        catalog.add_results({f'Game {i}': {'uri': f'games/{i}-game-{i}', 'best_price': ''} for i in range(1, 3001)})
+        catalog.add_results({'Game': {'uri': 'games/5000-game', 'best_price': ''}})
+        catalog.complete = True
+
+        results = catalog.search('game', '')
+        self.assertEqual(len(results), 1)
+
+        results = catalog.search('gam', '')
+        self.assertEqual(len(results), 30)
+        self.assertEqual(list(results)[0], 'Game')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Outbox import Outbox
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: dict):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+class FakeSession:
+    # Answers every POST with the next of responses (the last one once they run out), recording when it was made
+    def __init__(self, responses: [(int, dict)]):
+        self.responses = list(responses)
+        self.posted_at = []
+
+    def post(self, url: str, json: dict = None, timeout: float = None):
+        self.posted_at.append(time.monotonic())
+        status_code, body = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        return FakeResponse(status_code, body)
+
+class OutboxRetryTest(unittest.TestCase):
+    def send_chat_action(self, session: FakeSession, **outbox_args) -> Outbox:
+        outbox = Outbox(session, 'http://telegram', workers=1, **outbox_args)
+        outbox.enqueue(1, 'sendChatAction', {'chat_id': 1, 'action': 'typing'})
+        outbox.close(timeout=5)
+        return outbox
+
+    def test_rate_limited_chat_action_waits_retry_after(self):
+        session = FakeSession([(429, {'parameters': {'retry_after': 0.1}}), (429, {'parameters': {'retry_after': 0.1}}), (200, {})])
+        outbox = self.send_chat_action(session)
+
+        self.assertEqual(len(session.posted_at), 3)
+        for previous, posted_at in zip(session.posted_at, session.posted_at[1:]):
+            self.assertGreaterEqual(posted_at - previous, 0.09)
+        self.assertEqual(outbox.stats()['sent'], 1)
+
+    def test_failing_chat_action_backs_off(self):
+        session = FakeSession([(502, {})])
+        outbox = self.send_chat_action(session, max_attempts=3, backoff=0.05)
+
+        self.assertEqual(len(session.posted_at), 3)
+        self.assertGreaterEqual(session.posted_at[1] - session.posted_at[0], 0.045)
+        self.assertGreaterEqual(session.posted_at[2] - session.posted_at[1], 0.095)
+        self.assertEqual(outbox.stats()['failed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
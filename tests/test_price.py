@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Price import Price, parse_amount, format_amount
+from ExchangeRates import convert_price
+
+class ParseAmountTest(unittest.TestCase):
+    def test_decimals(self):
+        self.assertEqual(parse_amount('MX$ 37.70'), 3770)
+        self.assertEqual(parse_amount('Kč 1.234,56'), 123456)
+        self.assertEqual(parse_amount('R$ 199,9'), 19990)
+        self.assertEqual(parse_amount('$ 60'), 6000)
+
+    def test_thousands(self):
+        self.assertEqual(parse_amount('¥ 6,578'), 657800)
+        self.assertEqual(parse_amount('$ 1,299.99'), 129999)
+
+    def test_currencies_without_decimals(self):
+        self.assertEqual(parse_amount('CLP$ 42.990', 'CLP'), 4299000)
+        self.assertEqual(parse_amount('₩ 64,800', 'KRW'), 6480000)
+        self.assertEqual(parse_amount('CLP$ 42.99', 'CLP'), 429900)
+        self.assertEqual(Price.parse('¥ 1,20', country_code='JP').amount, 12000)
+
+    def test_no_amount(self):
+        self.assertIsNone(parse_amount(None))
+        self.assertIsNone(parse_amount('Free'))
+
+class FormatAmountTest(unittest.TestCase):
+    def test_decimals(self):
+        self.assertEqual(format_amount(123456, 'BRL'), 'R$ 1.234,56')
+        self.assertEqual(format_amount(5999, 'USD'), '$ 59.99')
+        self.assertEqual(format_amount(None, 'USD'), '')
+
+    def test_currencies_without_decimals(self):
+        self.assertEqual(format_amount(657800, 'JPY'), '¥ 6,578')
+        self.assertEqual(format_amount(6480000, 'KRW'), '₩ 64,800')
+        self.assertEqual(format_amount(4299000, 'CLP'), 'CLP$ 42.990')
+
+    def test_unknown_currency(self):
+        self.assertEqual(format_amount(1050, 'XYZ'), 'XYZ 10.50')
+
+    def test_round_trip(self):
+        for price_text, currency in (('R$ 1.234,56', 'BRL'), ('¥ 6,578', 'JPY'), ('CLP$ 42.990', 'CLP'), ('£ 49.99', 'GBP')):
+            self.assertEqual(format_amount(parse_amount(price_text, currency), currency), price_text)
+
+class ConvertPriceTest(unittest.TestCase):
+    def test_rounded_to_currency_decimals(self):
+        price = Price('United States', 'US', 5999, 5999, 'USD')
+        converted = convert_price(price, {'USD': 147.123}, 'JPY')
+        self.assertEqual(converted.amount, 882600)
+        self.assertEqual(str(converted), '¥ 8,826')
+
+if __name__ == '__main__':
+    unittest.main()
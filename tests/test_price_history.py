@@ -0,0 +1,52 @@
+import os
+import sys
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Price import Price
+from StateStore import StateStore
+from PriceHistory import PriceHistory
+
+class PriceHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.state_dir.name, 'state.db')
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_runs_recorded_under_chat_currencies_are_merged(self):
+        # A database from before price_currency and the canonical key
+        connection = sqlite3.connect(self.path)
+        connection.executescript('''
+            CREATE TABLE price_history (
+                game_id INTEGER NOT NULL, currency TEXT NOT NULL, country TEXT NOT NULL, first_seen REAL NOT NULL, last_seen REAL NOT NULL,
+                price INTEGER, price_text TEXT, discount INTEGER NOT NULL,
+                PRIMARY KEY (game_id, currency, country, first_seen)
+            ) WITHOUT ROWID;
+            INSERT INTO price_history VALUES (1, 'brl', 'Brazil', 100, 200, 19990, 'R$ 199,90', 0);
+            INSERT INTO price_history VALUES (1, 'usd', 'Brazil', 100, 300, 19990, 'R$ 199,90', 0);
+            INSERT INTO price_history VALUES (1, 'usd', 'United States', 150, 300, 5999, '$ 59.99', 0);
+        ''')
+        connection.close()
+
+        store = StateStore(self.path)
+        self.assertEqual(store.merge_price_history(''), 2)
+
+        summary = {entry['country']: entry for entry in PriceHistory(store).summary(1, '')}
+        self.assertEqual(set(summary), {'Brazil', 'United States'})
+        self.assertEqual(summary['Brazil']['currency'], 'BRL')
+        self.assertEqual(summary['United States']['current_price'], 5999)
+
+    def test_currency_is_recorded(self):
+        history = PriceHistory(StateStore(self.path))
+        history.record(1, '', [Price('Sweden', 'SE', 49900, 49900, 'SEK'), Price('Norway', 'NO', 52900, 52900, 'NOK')], now=100)
+
+        summary = {entry['country']: entry['currency'] for entry in history.summary(1, '')}
+        self.assertEqual(summary, {'Sweden': 'SEK', 'Norway': 'NOK'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from StateStore import StateStore
+from PricesCache import PricesCache
+
+class SharedStoreTest(unittest.TestCase):
+    def test_expired_entry_does_not_delete_another_process_row(self):
+        with tempfile.TemporaryDirectory() as state_dir:
+            path = os.path.join(state_dir, 'state.db')
+            store_a, store_b = StateStore(path), StateStore(path)
+            cache_a, cache_b = PricesCache(), PricesCache()
+            cache_a.loader, cache_b.loader = store_a.load_cache_entry, store_b.load_cache_entry
+
+            cache_a.put('key', 'old', ttl=0.05)
+            store_a.save(cache_entries=cache_a.take_changes()[0])
+            time.sleep(0.1)
+
+            # Another shard writes a fresh entry, A's copy has expired meanwhile
+            cache_b.put('key', 'fresh')
+            store_b.save(cache_entries=cache_b.take_changes()[0])
+            self.assertEqual(cache_a.get('key'), 'fresh')
+
+            changed, removed = cache_a.take_changes()
+            store_a.save(cache_entries=changed, removed_cache_keys=removed)
+            self.assertEqual(store_b.load_cache_entry('key')[0], 'fresh')
+
+if __name__ == '__main__':
+    unittest.main()